@@ -1,8 +1,12 @@
 #!/usr/bin/env python
 
+import argparse
 import random
 import numpy as np
 from utils.treebank import StanfordSentiment
+from utils.cooccurrence import cooccurrenceCounts
+from utils.ppmi import ppmiVectors
+import utils.glove as glove
 import matplotlib
 matplotlib.use('agg')
 import matplotlib.pyplot as plt
@@ -11,6 +15,18 @@ import time
 from q3_word2vec import *
 from q3_sgd import *
 
+parser = argparse.ArgumentParser()
+parser.add_argument("--method", choices=["sgd", "glove", "ppmi"],
+                    default="sgd",
+                    help="Train word2vec with SGD, GloVe on co-occurrence "
+                         "counts, or factorize the PPMI matrix with SVD.")
+parser.add_argument("--jobs", type=int, default=1,
+                    help="Worker processes that share each SGD minibatch.")
+args = parser.parse_args()
+
+# Number of SGD iterations
+ITERATIONS = 40000
+
 # Reset the random seed to make sure that everyone gets the same results
 random.seed(314)
 dataset = StanfordSentiment()
@@ -28,18 +44,35 @@ random.seed(31415)
 np.random.seed(9265)
 
 startTime=time.time()
-wordVectors = np.concatenate(
-    ((np.random.rand(nWords, dimVectors) - 0.5) /
-       dimVectors, np.zeros((nWords, dimVectors))),
-    axis=0)
-wordVectors = sgd(
-    lambda vec: word2vec_sgd_wrapper(skipgram, tokens, vec, dataset, C,
-        negSamplingCostAndGradient),
-    wordVectors, 0.3, 40000, None, True, PRINT_EVERY=10)
-# Note that normalization is not called here. This is not a bug,
-# normalizing during training loses the notion of length.
-
-print "sanity check: cost at convergence should be around or below 10"
+if args.method == "sgd":
+    wordVectors = np.concatenate(
+        ((np.random.rand(nWords, dimVectors) - 0.5) /
+           dimVectors, np.zeros((nWords, dimVectors))),
+        axis=0)
+    if args.jobs > 1:
+        costAndGradient = ParallelWord2vec(args.jobs, skipgram, tokens,
+            wordVectors, dataset, C, negSamplingCostAndGradient)
+    else:
+        costAndGradient = lambda vec: word2vec_sgd_wrapper(skipgram, tokens,
+            vec, dataset, C, negSamplingCostAndGradient)
+    wordVectors = sgd(costAndGradient, wordVectors, 0.3, ITERATIONS, None,
+        True, PRINT_EVERY=10)
+    if args.jobs > 1:
+        costAndGradient.close()
+    # Note that normalization is not called here. This is not a bug,
+    # normalizing during training loses the notion of length.
+
+    print "sanity check: cost at convergence should be around or below 10"
+elif args.method == "glove":
+    wordVectors = glove.trainGloVe(cooccurrenceCounts(dataset, C),
+                                   dimensions=dimVectors)
+    # Loaded by q4_sentiment.py --yourvectors glove
+    save_vectors(args.method, wordVectors)
+elif args.method == "ppmi":
+    wordVectors = ppmiVectors(dataset, dimVectors, C)
+    # Loaded by q4_sentiment.py --yourvectors ppmi
+    save_vectors(args.method, wordVectors)
+
 print "training took %d seconds" % (time.time() - startTime)
 
 # concatenate the input and output word vectors
@@ -36,6 +36,18 @@ def save_params(iter, params):
         pickle.dump(random.getstate(), f)
 
 
+def save_vectors(method, vectors):
+    """
+    Save word vectors trained by a method other than SGD. They get a file
+    of their own, so they never shadow an SGD checkpoint.
+    """
+    np.save("saved_vectors_%s.npy" % method, vectors)
+
+
+def load_vectors(method):
+    return np.load("saved_vectors_%s.npy" % method)
+
+
 def sgd(f, x0, step, iterations, postprocessing=None, useSaved=False,
         PRINT_EVERY=10):
     """ Stochastic Gradient Descent
@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 
+import multiprocessing as mp
 import numpy as np
 import random
 
@@ -207,8 +208,8 @@ def cbow(currentWord, C, contextWords, tokens, inputVectors, outputVectors,
 #############################################
 
 def word2vec_sgd_wrapper(word2vecModel, tokens, wordVectors, dataset, C,
-                         word2vecCostAndGradient=softmaxCostAndGradient):
-    batchsize = 50
+                         word2vecCostAndGradient=softmaxCostAndGradient,
+                         batchsize=50):
     cost = 0.0
     grad = np.zeros(wordVectors.shape)
     N = wordVectors.shape[0]
@@ -233,6 +234,74 @@ def word2vec_sgd_wrapper(word2vecModel, tokens, wordVectors, dataset, C,
     return cost, grad
 
 
+# Model, data and shared word vectors of this worker process, set by
+# initWord2vecWorker
+word2vecWorker = None
+
+
+def initWord2vecWorker(word2vecModel, tokens, sharedVectors, shape, dataset,
+                       sharedTable, C, word2vecCostAndGradient):
+    global word2vecWorker
+    dataset.attachSampleTable(sharedTable)
+    wordVectors = np.frombuffer(sharedVectors).reshape(shape)
+    word2vecWorker = (word2vecModel, tokens, wordVectors, dataset, C,
+                      word2vecCostAndGradient)
+
+
+def word2vecWorkerBatch(args):
+    """
+    Cost and gradient of a part of a minibatch, as a fraction of the whole
+    minibatch. Only the rows of the gradient that are nonzero are returned.
+    """
+    seed, batchsize, total = args
+    random.seed(seed)
+    cost, grad = word2vec_sgd_wrapper(*word2vecWorker, batchsize=batchsize)
+    weight = float(batchsize) / total
+    rows = np.flatnonzero(np.any(grad != 0, axis=1))
+    return cost * weight, rows, grad[rows] * weight
+
+
+class ParallelWord2vec(object):
+    """ word2vec_sgd_wrapper with each minibatch split over worker processes
+
+    The workers read the current word vectors from shared memory and draw
+    negative samples from the dataset's shared sample table, so neither is
+    copied per step or per process. Each part of a minibatch is drawn with
+    its own seed, taken from the random module of the calling process, so
+    runs are repeatable, but not identical to word2vec_sgd_wrapper.
+    Call close() when done.
+    """
+
+    def __init__(self, jobs, word2vecModel, tokens, wordVectors, dataset, C,
+                 word2vecCostAndGradient=softmaxCostAndGradient,
+                 batchsize=50):
+        self.sharedVectors = mp.RawArray("d", wordVectors.size)
+        self.wordVectors = np.frombuffer(self.sharedVectors).reshape(
+            wordVectors.shape)
+        self.sizes = [batchsize // jobs + (i < batchsize % jobs)
+                      for i in xrange(jobs)]
+        self.sizes = [n for n in self.sizes if n > 0]
+        self.batchsize = batchsize
+        self.pool = mp.Pool(jobs, initializer=initWord2vecWorker, initargs=(
+            word2vecModel, tokens, self.sharedVectors, wordVectors.shape,
+            dataset, dataset.shareSampleTable(), C, word2vecCostAndGradient))
+
+    def __call__(self, wordVectors):
+        self.wordVectors[:] = wordVectors
+        tasks = [(random.randint(0, 2 ** 31 - 1), n, self.batchsize)
+                 for n in self.sizes]
+        cost = 0.0
+        grad = np.zeros(wordVectors.shape)
+        for c, rows, g in self.pool.map(word2vecWorkerBatch, tasks):
+            cost += c
+            grad[rows] += g
+        return cost, grad
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
 def test_word2vec():
     """ Interface to the dataset for negative sampling """
     dataset = type('dummy', (), {})()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+import argparse
+import collections
+import itertools
+import multiprocessing as mp
+import sys
+import time
+
+import numpy as np
+
+from utils.treebank import tokenize
+from q4_sentiment import getSentenceMatrix, loadModel, loadScoreTable
+
+
+def getArguments():
+    parser = argparse.ArgumentParser(
+        description="Score a file of raw sentences with a classifier saved "
+                    "by q4_sentiment.py.")
+    parser.add_argument("input", help="One sentence per line; - for stdin.")
+    parser.add_argument("output", help="TSV predictions; - for stdout.")
+    parser.add_argument("--model", default="q4_model.pickle",
+                        help="Classifier saved by q4_sentiment.py.")
+    parser.add_argument("--table",
+                        help="Score with the per-word class score table saved "
+                             "by q4_sentiment.py instead of --model.")
+    parser.add_argument("--labeled", action="store_true",
+                        help="Input lines are 'label<TAB>sentence'; the true "
+                             "label is copied to the output.")
+    parser.add_argument("--jobs", type=int, default=mp.cpu_count(),
+                        help="Worker processes.")
+    parser.add_argument("--chunksize", type=int, default=10000,
+                        help="Sentences per work unit.")
+    return parser.parse_args()
+
+
+# The model loaded in this (worker) process
+model = None
+
+
+def initWorker(modelFile, tableFile=None):
+    global model
+    if tableFile:
+        model = loadScoreTable(tableFile)
+    else:
+        model = loadModel(modelFile)
+
+
+def scoreChunk(lines, labeled=False, firstLine=1):
+    """
+    Predict the sentiment of a chunk of lines, returning the TSV rows and
+    the numbers of the lines that were skipped. In labeled mode, lines
+    without a tab are skipped; firstLine is the number of lines[0].
+    """
+    skipped = []
+    if labeled:
+        labels, texts = [], []
+        for i, line in enumerate(lines):
+            fields = line.split("\t", 1)
+            if len(fields) < 2:
+                skipped.append(firstLine + i)
+                continue
+            labels.append(fields[0])
+            texts.append(fields[1])
+    else:
+        texts = lines
+    texts = [text.strip() for text in texts]
+    if not texts:
+        return "", skipped
+
+    matrix = getSentenceMatrix(model["tokens"],
+                               [tokenize(text) for text in texts],
+                               unknown="UNK")
+    if "table" in model:
+        scores = matrix.dot(model["table"]) + model["bias"]
+        pred = model["classes"][np.argmax(scores, axis=1)]
+    else:
+        pred = model["clf"].predict(matrix.dot(model["wordVectors"]))
+
+    if labeled:
+        rows = ["%s\t%d\t%s" % row for row in zip(labels, pred, texts)]
+    else:
+        rows = ["%d\t%s" % row for row in zip(pred, texts)]
+    return "".join(row + "\n" for row in rows), skipped
+
+
+def scoreChunkStar(args):
+    return scoreChunk(*args)
+
+
+def writeChunk(outfile, result):
+    """ Write the rows of a scored chunk, warning about skipped lines """
+    rows, skipped = result
+    outfile.write(rows)
+    for lineNumber in skipped:
+        print >> sys.stderr, "warning: line %d has no label, skipped" % (
+            lineNumber)
+    return len(skipped)
+
+
+def readChunks(f, chunksize):
+    while True:
+        chunk = list(itertools.islice(f, chunksize))
+        if not chunk:
+            return
+        yield chunk
+
+
+def main(args):
+    infile = sys.stdin if args.input == "-" else open(args.input, "r")
+    outfile = sys.stdout if args.output == "-" else open(args.output, "w")
+    outfile.write("True\tPredicted\tText\n" if args.labeled
+                  else "Predicted\tText\n")
+
+    startTime = time.time()
+    nSentences = 0
+    nSkipped = 0
+    if args.jobs <= 1:
+        initWorker(args.model, args.table)
+        for chunk in readChunks(infile, args.chunksize):
+            nSkipped += writeChunk(outfile, scoreChunk(
+                chunk, args.labeled, nSentences + 1))
+            nSentences += len(chunk)
+    else:
+        # Keep only a few chunks in flight so memory stays bounded however
+        # large the input is, and write results in input order.
+        pool = mp.Pool(args.jobs, initializer=initWorker,
+                       initargs=(args.model, args.table))
+        pending = collections.deque()
+        try:
+            for chunk in readChunks(infile, args.chunksize):
+                pending.append(pool.apply_async(scoreChunkStar, (
+                    (chunk, args.labeled, nSentences + 1),)))
+                nSentences += len(chunk)
+                if len(pending) >= 2 * args.jobs:
+                    nSkipped += writeChunk(outfile, pending.popleft().get())
+            while pending:
+                nSkipped += writeChunk(outfile, pending.popleft().get())
+        finally:
+            pool.close()
+            pool.join()
+
+    outfile.flush()
+    elapsed = time.time() - startTime
+    nSentences -= nSkipped
+    print >> sys.stderr, "scored %d sentences in %.1f seconds (%.0f/s)" % (
+        nSentences, elapsed, nSentences / max(elapsed, 1e-9))
+    if nSkipped:
+        print >> sys.stderr, "skipped %d lines without a label" % nSkipped
+
+
+if __name__ == "__main__":
+    main(getArguments())
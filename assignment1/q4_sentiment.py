@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 
 import argparse
+import copy
+import cPickle as pickle
+import multiprocessing as mp
 import numpy as np
 import matplotlib
 matplotlib.use('agg')
@@ -10,13 +13,15 @@ import itertools
 from utils.treebank import StanfordSentiment
 import utils.glove as glove
 
-from q3_sgd import load_saved_params, sgd
+from q3_sgd import load_saved_params, load_vectors, sgd
+from q4_softmaxreg import trainSoftmaxRegressions, SoftmaxClassifier
 
 # We will use sklearn here because it will run faster than implementing
 # ourselves. However, for other parts of this assignment you must implement
 # the functions yourself!
 from sklearn.linear_model import LogisticRegression
 from sklearn.metrics import confusion_matrix
+from scipy.sparse import csr_matrix
 
 
 def getArguments():
@@ -24,8 +29,28 @@ def getArguments():
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument("--pretrained", dest="pretrained", action="store_true",
                        help="Use pretrained GloVe vectors.")
-    group.add_argument("--yourvectors", dest="yourvectors", action="store_true",
-                       help="Use your vectors from q3.")
+    group.add_argument("--yourvectors", dest="yourvectors", nargs="?",
+                       const="sgd", choices=["sgd", "glove", "ppmi"],
+                       help="Use your vectors from q3, trained with the given "
+                            "q3_run.py --method (default sgd).")
+    parser.add_argument("--jobs", type=int, default=mp.cpu_count(),
+                        help="Worker processes for the regularization sweep.")
+    parser.add_argument("--warmstart", action="store_true",
+                        help="Warm-start each fit from its neighbour on the "
+                             "regularization path. This fits a different "
+                             "model: multinomial logistic regression with "
+                             "lbfgs instead of one-vs-rest liblinear, so its "
+                             "accuracies are not comparable with a default "
+                             "sweep.")
+    parser.add_argument("--batched", action="store_true",
+                        help="Train the whole sweep as one batched NumPy "
+                             "softmax regression instead of sklearn fits.")
+    parser.add_argument("--model", default="q4_model.pickle",
+                        help="Where to save the best classifier for "
+                             "q4_score.py.")
+    parser.add_argument("--scoretable", default="q4_scoretable.npz",
+                        help="Where to save the per-word class scores of "
+                             "the best classifier for q4_score.py --table.")
     return parser.parse_args()
 
 
@@ -64,6 +89,32 @@ def getSentenceFeatures(tokens, wordVectors, sentence):
     return sentVector
 
 
+def getSentenceMatrix(tokens, sentences, unknown=None):
+    """
+    Averaging matrix for a list of sentences: a sparse (nSentences, nWords)
+    matrix whose row i holds 1/len(sentence) at the index of every word of
+    sentence i. Its product with wordVectors gives the features of all
+    sentences at once, and it can be reused with different word vectors.
+
+    Words missing from tokens are mapped to the token unknown when it is
+    given; empty sentences get all-zero rows.
+    """
+    if unknown is None:
+        ids = [tokens[word] for sentence in sentences for word in sentence]
+    else:
+        unknownId = tokens[unknown]
+        ids = [tokens.get(word, unknownId)
+               for sentence in sentences for word in sentence]
+    lengths = np.array([len(sentence) for sentence in sentences], dtype=np.int64)
+    indptr = np.concatenate(([0], np.cumsum(lengths)))
+    data = np.repeat(1.0 / np.maximum(lengths, 1), lengths)
+    return csr_matrix((data, ids, indptr), shape=(len(sentences), len(tokens)))
+
+
+def getLabels(dataset):
+    return np.array([label for _, label in dataset], dtype=np.int32)
+
+
 def getRegularizationValues():
     """Try different regularizations
 
@@ -116,6 +167,146 @@ def accuracy(y, yhat):
     return np.sum(y == yhat) * 100.0 / y.size
 
 
+# Features and labels of the sweep, set in each worker process
+sweepData = None
+
+
+def initSweep(data):
+    global sweepData
+    sweepData = data
+
+
+def fitRegPath(regValues, warmStart=False):
+    """
+    Fit one classifier per regularization value and evaluate it on the
+    train, dev and test sets. With warmStart, the values are visited from
+    strongest to weakest regularization and each fit starts from the
+    previous solution. liblinear cannot warm start, so those fits are
+    multinomial lbfgs models rather than the default one-vs-rest ones
+    (see describeSweep).
+    """
+    (trainFeatures, trainLabels, devFeatures, devLabels,
+     testFeatures, testLabels) = sweepData
+
+    results = []
+    clf = None
+    path = reversed(regValues) if warmStart else regValues
+    for reg in path:
+        print "Training for reg=%f" % reg
+        # Note: add a very small number to regularization to please the library
+        if warmStart:
+            if clf is None:
+                clf = LogisticRegression(solver="lbfgs",
+                                         multi_class="multinomial",
+                                         warm_start=True, max_iter=1000)
+            clf.set_params(C=1.0/(reg + 1e-12))
+            clf.fit(trainFeatures, trainLabels)
+            fitted = copy.deepcopy(clf)
+        else:
+            fitted = LogisticRegression(C=1.0/(reg + 1e-12))
+            fitted.fit(trainFeatures, trainLabels)
+
+        # Test on train set
+        pred = fitted.predict(trainFeatures)
+        trainAccuracy = accuracy(trainLabels, pred)
+        print "Train accuracy (%%): %f" % trainAccuracy
+
+        # Test on dev set
+        pred = fitted.predict(devFeatures)
+        devAccuracy = accuracy(devLabels, pred)
+        print "Dev accuracy (%%): %f" % devAccuracy
+
+        # Test on test set
+        # Note: always running on test is poor style. Typically, you should
+        # do this only after validation.
+        pred = fitted.predict(testFeatures)
+        testAccuracy = accuracy(testLabels, pred)
+        print "Test accuracy (%%): %f" % testAccuracy
+
+        results.append({
+            "reg": reg,
+            "clf": fitted,
+            "train": trainAccuracy,
+            "dev": devAccuracy,
+            "test": testAccuracy})
+
+    if warmStart:
+        results.reverse()
+    return results
+
+
+def fitRegPathStar(args):
+    return fitRegPath(*args)
+
+
+def regularizationSweep(data, regValues, jobs=1, warmStart=False):
+    """
+    Run fitRegPath over the sorted regValues on a pool of jobs worker
+    processes. Each worker takes one contiguous stretch of the path, so
+    warm starts still follow neighbouring values. The feature matrices
+    are handed to the workers once when the pool starts; forked workers
+    share them with the parent instead of copying them per task.
+
+    Returns the results of all values in the order of regValues.
+    """
+    jobs = max(1, min(jobs, len(regValues)))
+    if jobs == 1:
+        initSweep(data)
+        return fitRegPath(regValues, warmStart)
+
+    segments = [list(segment) for segment in np.array_split(regValues, jobs)]
+    pool = mp.Pool(jobs, initializer=initSweep, initargs=(data,))
+    try:
+        parts = pool.map(fitRegPathStar,
+                         [(segment, warmStart) for segment in segments])
+    finally:
+        pool.close()
+        pool.join()
+    return [result for part in parts for result in part]
+
+
+def batchedSweep(data, regValues):
+    """
+    Regularization sweep with all values trained together by
+    trainSoftmaxRegressions. The models are multinomial softmax
+    regressions, like the --warmstart sweep, not the one-vs-rest models of
+    the default sweep, so their accuracies differ from a default run.
+    A constant feature is appended so that the models get a bias; like
+    LogisticRegression's intercept, it is not regularized. The cost is a
+    mean over the N training examples, so reg corresponds to
+    C = 1 / (reg * N) in LogisticRegression, not to C = 1 / reg.
+    """
+    (trainFeatures, trainLabels, devFeatures, devLabels,
+     testFeatures, testLabels) = data
+    withBias = lambda features: np.hstack(
+        (features, np.ones((features.shape[0], 1))))
+
+    weights = trainSoftmaxRegressions(withBias(trainFeatures), trainLabels,
+                                      regValues, bias=True)
+    accuracies = []
+    for features, labels in ((trainFeatures, trainLabels),
+                             (devFeatures, devLabels),
+                             (testFeatures, testLabels)):
+        pred = np.argmax(np.matmul(withBias(features), weights), axis=2)
+        accuracies.append([accuracy(labels, p) for p in pred])
+
+    return [{"reg": reg,
+             "clf": SoftmaxClassifier(weights[r, :-1], weights[r, -1]),
+             "train": accuracies[0][r],
+             "dev": accuracies[1][r],
+             "test": accuracies[2][r]}
+            for r, reg in enumerate(regValues)]
+
+
+def describeSweep(args):
+    """ The model family that a sweep run with these arguments fits """
+    if args.batched:
+        return "multinomial softmax regression (batched FISTA)"
+    if args.warmstart:
+        return "multinomial logistic regression (lbfgs, warm-started)"
+    return "one-vs-rest logistic regression (liblinear)"
+
+
 def plotRegVsAccuracy(regValues, results, filename):
     """ Make a plot of regularization vs accuracy """
     plt.plot(regValues, [x["train"] for x in results])
@@ -159,6 +350,61 @@ def outputPredictions(dataset, features, labels, clf, filename):
                 labels[i], pred[i], " ".join(dataset[i][0]))
 
 
+def saveModel(filename, tokens, wordVectors, clf):
+    """ Save everything needed to score new sentences """
+    with open(filename, "wb") as f:
+        pickle.dump({"tokens": tokens,
+                     "wordVectors": np.asarray(wordVectors),
+                     "clf": clf}, f, pickle.HIGHEST_PROTOCOL)
+
+
+def loadModel(filename):
+    with open(filename, "rb") as f:
+        return pickle.load(f)
+
+
+def getScoreTable(wordVectors, clf):
+    """
+    Per-word class scores of a linear classifier on averaged word vectors.
+
+    Averaging and the classifier are both linear, so the class scores of a
+    sentence are the average of its words' rows of wordVectors.dot(W),
+    plus the bias. Scoring then averages K-wide rows instead of D-wide
+    ones.
+
+    Returns the (nWords, K) table, the (K,) bias and the class labels.
+    """
+    if hasattr(clf, "coef_"):
+        # sklearn LogisticRegression
+        weights, bias, classes = clf.coef_.T, clf.intercept_, clf.classes_
+    else:
+        # q4_softmaxreg.SoftmaxClassifier
+        weights, bias = clf.weights, clf.bias
+        classes = np.arange(weights.shape[1])
+    return (np.asarray(wordVectors).dot(weights),
+            np.zeros(weights.shape[1]) + bias, classes)
+
+
+def saveScoreTable(filename, tokens, wordVectors, clf):
+    table, bias, classes = getScoreTable(wordVectors, clf)
+    words = [None] * len(tokens)
+    for word, idx in tokens.iteritems():
+        words[idx] = word
+    with open(filename, "wb") as f:
+        np.savez(f, words=np.array(words), table=table, bias=bias,
+                 classes=classes)
+
+
+def loadScoreTable(filename):
+    """ Load a score table in the form of a model saved by saveModel """
+    data = np.load(filename)
+    words = data["words"].tolist()
+    return {"tokens": dict(zip(words, xrange(len(words)))),
+            "table": data["table"],
+            "bias": data["bias"],
+            "classes": data["classes"]}
+
+
 def main(args):
     """ Train a model to do sentiment analyis"""
 
@@ -168,77 +414,48 @@ def main(args):
     nWords = len(tokens)
 
     if args.yourvectors:
-        _, wordVectors, _ = load_saved_params()
+        if args.yourvectors == "sgd":
+            _, wordVectors, _ = load_saved_params()
+        else:
+            wordVectors = load_vectors(args.yourvectors)
         wordVectors = np.concatenate(
             (wordVectors[:nWords,:], wordVectors[nWords:,:]),
             axis=1)
     elif args.pretrained:
         wordVectors = glove.loadWordVectors(tokens)
-    dimVectors = wordVectors.shape[1]
 
     # Load the train set
     trainset = dataset.getTrainSentences()
-    nTrain = len(trainset)
-    trainFeatures = np.zeros((nTrain, dimVectors))
-    trainLabels = np.zeros((nTrain,), dtype=np.int32)
-    for i in xrange(nTrain):
-        words, trainLabels[i] = trainset[i]
-        trainFeatures[i, :] = getSentenceFeatures(tokens, wordVectors, words)
+    trainMatrix = getSentenceMatrix(tokens, [words for words, _ in trainset])
+    trainFeatures = trainMatrix.dot(wordVectors)
+    trainLabels = getLabels(trainset)
 
     # Prepare dev set features
     devset = dataset.getDevSentences()
-    nDev = len(devset)
-    devFeatures = np.zeros((nDev, dimVectors))
-    devLabels = np.zeros((nDev,), dtype=np.int32)
-    for i in xrange(nDev):
-        words, devLabels[i] = devset[i]
-        devFeatures[i, :] = getSentenceFeatures(tokens, wordVectors, words)
+    devMatrix = getSentenceMatrix(tokens, [words for words, _ in devset])
+    devFeatures = devMatrix.dot(wordVectors)
+    devLabels = getLabels(devset)
 
     # Prepare test set features
     testset = dataset.getTestSentences()
-    nTest = len(testset)
-    testFeatures = np.zeros((nTest, dimVectors))
-    testLabels = np.zeros((nTest,), dtype=np.int32)
-    for i in xrange(nTest):
-        words, testLabels[i] = testset[i]
-        testFeatures[i, :] = getSentenceFeatures(tokens, wordVectors, words)
+    testMatrix = getSentenceMatrix(tokens, [words for words, _ in testset])
+    testFeatures = testMatrix.dot(wordVectors)
+    testLabels = getLabels(testset)
 
     # We will save our results from each run
-    results = []
     regValues = getRegularizationValues()
-    for reg in regValues:
-        print "Training for reg=%f" % reg
-        # Note: add a very small number to regularization to please the library
-        clf = LogisticRegression(C=1.0/(reg + 1e-12))
-        clf.fit(trainFeatures, trainLabels)
-
-        # Test on train set
-        pred = clf.predict(trainFeatures)
-        trainAccuracy = accuracy(trainLabels, pred)
-        print "Train accuracy (%%): %f" % trainAccuracy
-
-        # Test on dev set
-        pred = clf.predict(devFeatures)
-        devAccuracy = accuracy(devLabels, pred)
-        print "Dev accuracy (%%): %f" % devAccuracy
-
-        # Test on test set
-        # Note: always running on test is poor style. Typically, you should
-        # do this only after validation.
-        pred = clf.predict(testFeatures)
-        testAccuracy = accuracy(testLabels, pred)
-        print "Test accuracy (%%): %f" % testAccuracy
-
-        results.append({
-            "reg": reg,
-            "clf": clf,
-            "train": trainAccuracy,
-            "dev": devAccuracy,
-            "test": testAccuracy})
+    data = (trainFeatures, trainLabels, devFeatures, devLabels,
+            testFeatures, testLabels)
+    if args.batched:
+        results = batchedSweep(data, regValues)
+    else:
+        results = regularizationSweep(data, regValues, args.jobs,
+                                      args.warmstart)
 
     # Print the accuracies
     print ""
     print "=== Recap ==="
+    print "Model: %s" % describeSweep(args)
     print "Reg\t\tTrain\tDev\tTest"
     for result in results:
         print "%.2E\t%.3f\t%.3f\t%.3f" % (
@@ -251,6 +468,8 @@ def main(args):
     bestResult = chooseBestModel(results)
     print "Best regularization value: %0.2E" % bestResult["reg"]
     print "Test accuracy (%%): %f" % bestResult["test"]
+    saveModel(args.model, tokens, wordVectors, bestResult["clf"])
+    saveScoreTable(args.scoretable, tokens, wordVectors, bestResult["clf"])
 
     # do some error analysis
     if args.pretrained:
@@ -1,7 +1,7 @@
 import numpy as np
 import random
 
-from cs224d.data_utils import *
+from utils.treebank import StanfordSentiment
 
 from q1_softmax import softmax
 from q2_gradcheck import gradcheck_naive
@@ -23,7 +23,7 @@ def getSentenceFeature(tokens, wordVectors, sentence):
     sentVector = np.zeros((wordVectors.shape[1],))
     
     ### YOUR CODE HERE
-    raise NotImplementedError
+    sentVector = np.mean(wordVectors[[tokens[word] for word in sentence]], axis=0)
     ### END YOUR CODE
     
     return sentVector
@@ -55,7 +55,10 @@ def softmaxRegression(features, labels, weights, regularization = 0.0, nopredict
     cost += 0.5 * regularization * np.sum(weights ** 2)
     
     ### YOUR CODE HERE: compute the gradients and predictions
-    raise NotImplementedError
+    pred = np.argmax(prob, axis=-1)
+    dscores = prob.copy()
+    dscores[range(N), labels] -= 1
+    grad = features.T.dot(dscores) / N + regularization * weights
     ### END YOUR CODE
     
     if nopredictions:
@@ -63,6 +66,103 @@ def softmaxRegression(features, labels, weights, regularization = 0.0, nopredict
     else:
         return cost, grad, pred
 
+def softmaxRegressionBatch(features, labels, weights, regularization,
+                           nopredictions = False, bias = False):
+    """ R softmax regressions on the same data at once """
+    # Same as softmaxRegression, for a stack of weights of shape (R, D, K)
+    # and one regularization constant per stack entry. Every quantity is
+    # computed for all R models with batched matrix products. With bias,
+    # the last feature is a constant 1 and its row of weights (the bias)
+    # is left out of the L2 penalty.
+
+    # Output:
+    # - cost: (R,) costs
+    # - grad: (R, D, K) gradients
+    # - pred: (R, N) label predictions
+
+    N = features.shape[0]
+    regularization = np.asarray(regularization, dtype=np.float64)
+    penalized = weights[:, :-1] if bias else weights
+
+    scores = np.matmul(features, weights)
+    scores -= np.max(scores, axis=2, keepdims=True)
+    prob = np.exp(scores)
+    prob /= np.sum(prob, axis=2, keepdims=True)
+
+    cost = -np.sum(np.log(prob[:, range(N), labels]), axis=1) / N
+    cost += 0.5 * regularization * np.sum(penalized ** 2, axis=(1, 2))
+
+    pred = np.argmax(prob, axis=2)
+    # prob is not needed any more, so the gradient overwrites it
+    dscores = prob
+    dscores[:, range(N), labels] -= 1
+    grad = np.matmul(features.T, dscores) / N
+    grad[:, :penalized.shape[1]] += (
+        regularization[:, np.newaxis, np.newaxis] * penalized)
+
+    if nopredictions:
+        return cost, grad
+    else:
+        return cost, grad, pred
+
+def trainSoftmaxRegressions(features, labels, regValues, nClasses = 5,
+                            iterations = 2000, tol = 1e-6, PRINT_EVERY = 100,
+                            bias = False):
+    """ Full-batch training of one softmax regression per regularization value
+
+    Runs accelerated gradient descent (FISTA with gradient-based restarts)
+    on the stacked (R, D, nClasses) weights, so every iteration is one
+    softmaxRegressionBatch call for the whole regularization sweep. Each
+    model takes steps of 1/L for its own Lipschitz constant L. With bias,
+    the last feature must be a constant 1; its weights are not regularized.
+
+    Returns the (R, D, nClasses) trained weights.
+    """
+    N, D = features.shape
+    regValues = np.asarray(regValues, dtype=np.float64)
+    R = len(regValues)
+
+    # The cross-entropy Hessian is bounded by X^T X / (2N)
+    lipschitz = 0.5 * np.linalg.norm(features, 2) ** 2 / N + regValues
+    step = (1.0 / lipschitz)[:, np.newaxis, np.newaxis]
+
+    weights = np.zeros((R, D, nClasses))
+    momentum = weights.copy()
+    t = np.ones((R,))
+    for iter in xrange(1, iterations + 1):
+        cost, grad = softmaxRegressionBatch(features, labels, momentum,
+                                            regValues, nopredictions = True,
+                                            bias = bias)
+        newWeights = momentum - step * grad
+        newT = (1 + np.sqrt(1 + 4 * t ** 2)) / 2
+
+        # Restart the momentum of models that are moving uphill
+        restart = np.sum(grad * (newWeights - weights), axis=(1, 2)) > 0
+        newT[restart] = 1
+        beta = ((t - 1) / newT)[:, np.newaxis, np.newaxis]
+        beta[restart] = 0
+        momentum = newWeights + beta * (newWeights - weights)
+        weights, t = newWeights, newT
+
+        gradNorm = np.sqrt(np.sum(grad ** 2, axis=(1, 2)))
+        if PRINT_EVERY and iter % PRINT_EVERY == 0:
+            print "iter %d: mean cost %f, max gradient norm %g" % (
+                iter, np.mean(cost), np.max(gradNorm))
+        if np.max(gradNorm) < tol:
+            break
+
+    return weights
+
+class SoftmaxClassifier(object):
+    """ Trained softmax regression with the predict() of a sklearn model """
+
+    def __init__(self, weights, bias = 0.0):
+        self.weights = weights
+        self.bias = bias
+
+    def predict(self, features):
+        return np.argmax(features.dot(self.weights) + self.bias, axis=-1)
+
 def accuracy(y, yhat):
     """ Precision for classifier """
     assert(y.shape == yhat.shape)
@@ -101,5 +201,46 @@ def sanity_check():
     print "\n=== Results ==="
     print softmaxRegression(dummy_features, dummy_labels, dummy_weights, 1.0)
 
+    print "\n==== Batched softmax regression ===="
+    regValues = [0.0, 0.1, 1.0]
+    stacked = np.array([dummy_weights] * len(regValues))
+    cost, grad, pred = softmaxRegressionBatch(dummy_features, dummy_labels,
+        stacked, regValues)
+    for r, reg in enumerate(regValues):
+        c, g, p = softmaxRegression(dummy_features, dummy_labels,
+            dummy_weights, reg)
+        assert np.allclose(cost[r], c) and np.allclose(grad[r], g)
+        assert np.all(pred[r] == p)
+        assert np.all(p == np.argmax(dummy_features.dot(dummy_weights), axis=-1))
+    weights = trainSoftmaxRegressions(dummy_features, dummy_labels, [0.1, 1.0],
+        PRINT_EVERY = 0)
+    for r, reg in enumerate([0.1, 1.0]):
+        _, g = softmax_wrapper(dummy_features, dummy_labels, weights[r], reg)
+        assert np.max(np.abs(g)) < 1e-5
+    withBias = np.hstack((dummy_features, np.ones((10, 1))))
+    biasWeights = np.vstack((dummy_weights, 0.1 * np.random.randn(1, 5)))
+    gradcheck_naive(lambda weights: tuple(x[0] for x in softmaxRegressionBatch(
+        withBias, dummy_labels, weights[np.newaxis], [1.0],
+        nopredictions = True, bias = True)), biasWeights)
+    _, g = softmax_wrapper(withBias, dummy_labels, biasWeights, 0.0)
+    _, gb = softmaxRegressionBatch(withBias, dummy_labels,
+        biasWeights[np.newaxis], [1.0], nopredictions = True, bias = True)
+    assert np.allclose(gb[0, -1], g[-1])
+    print "Batched costs, gradients and training pass"
+
+    print "\n==== Predictions on a separable toy set ===="
+    centers = 10 * np.eye(5)
+    toy_labels = np.arange(100) % 5
+    toy_features = centers[toy_labels] + np.random.randn(100, 5)
+    weights = trainSoftmaxRegressions(toy_features, toy_labels, [0.0, 0.01],
+        iterations = 500, PRINT_EVERY = 0)
+    _, _, pred = softmaxRegressionBatch(toy_features, toy_labels, weights,
+        [0.0, 0.01])
+    for r in xrange(len(weights)):
+        _, _, p = softmaxRegression(toy_features, toy_labels, weights[r])
+        assert accuracy(toy_labels, p) == 100.0
+        assert accuracy(toy_labels, pred[r]) == 100.0
+    print "Toy accuracy: 100%"
+
 if __name__ == "__main__":
     sanity_check()
\ No newline at end of file
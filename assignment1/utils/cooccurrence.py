@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+import numpy as np
+import os
+import shutil
+import tempfile
+import scipy.sparse as sp
+
+
+def sumByKey(keys, values):
+    """ Sort (keys, values) by key and add up the values of equal keys """
+    if len(keys) == 0:
+        return keys, values
+    order = np.argsort(keys, kind="mergesort")
+    keys = keys[order]
+    values = values[order]
+    starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+    return keys[starts], np.add.reduceat(values, starts)
+
+
+def windowPairs(ids, sentOf, windowSize, nTokens):
+    """
+    Keys (center * nTokens + context) and 1/distance weights of all
+    context pairs within windowSize of each other in the same sentence.
+    """
+    keys = []
+    values = []
+    for d in xrange(1, windowSize + 1):
+        same = sentOf[:-d] == sentOf[d:]
+        left = ids[:-d][same]
+        right = ids[d:][same]
+        weight = np.full(len(left), 1.0 / d)
+        keys += [left * nTokens + right, right * nTokens + left]
+        values += [weight, weight]
+    return np.concatenate(keys), np.concatenate(values)
+
+
+def spill(keys, values, tmpdir, n):
+    """ Write one sorted chunk to disk, returning its two file names """
+    names = (os.path.join(tmpdir, "keys_%d.npy" % n),
+             os.path.join(tmpdir, "values_%d.npy" % n))
+    np.save(names[0], keys)
+    np.save(names[1], values)
+    return names
+
+
+def mergeChunks(chunkFiles, maxEntries):
+    """
+    Merge sorted on-disk chunks into one sorted, summed (keys, values)
+    pair. The key space is cut into ranges holding about maxEntries
+    entries each, and only one range is in memory at a time.
+    """
+    chunks = [(np.load(k, mmap_mode="r"), np.load(v, mmap_mode="r"))
+              for k, v in chunkFiles]
+    total = sum(len(k) for k, _ in chunks)
+    nParts = max(1, int(np.ceil(total / float(maxEntries))))
+
+    # Range boundaries from evenly spaced samples of every chunk
+    stride = max(1, total // (nParts * 100))
+    sample = np.sort(np.concatenate([k[::stride] for k, _ in chunks]))
+    bounds = sample[np.linspace(0, len(sample), nParts + 1)[1:-1].astype(int)]
+    bounds = np.unique(bounds)
+
+    outKeys = []
+    outValues = []
+    lo = [0] * len(chunks)
+    for bound in list(bounds) + [None]:
+        partKeys = []
+        partValues = []
+        for c, (k, v) in enumerate(chunks):
+            hi = len(k) if bound is None else np.searchsorted(k, bound)
+            partKeys += [np.asarray(k[lo[c]:hi])]
+            partValues += [np.asarray(v[lo[c]:hi])]
+            lo[c] = hi
+        keys, values = sumByKey(np.concatenate(partKeys),
+                                np.concatenate(partValues))
+        outKeys += [keys]
+        outValues += [values]
+    return np.concatenate(outKeys), np.concatenate(outValues)
+
+
+def cooccurrenceCounts(dataset, windowSize=10, maxEntries=10000000,
+                       tmpdir=None):
+    """
+    Symmetric, distance-weighted co-occurrence counts of a StanfordSentiment
+    dataset: every pair of words d <= windowSize apart in a sentence adds
+    1/d to both X[w1, w2] and X[w2, w1].
+
+    Sentences are processed in blocks. Partial counts are summed in memory
+    and spilled to disk as sorted chunks whenever more than maxEntries are
+    pending, then merged at the end, so memory stays bounded by maxEntries
+    rather than by the number of pairs in the corpus.
+
+    Returns a (nTokens, nTokens) scipy.sparse.coo_matrix with sorted
+    entries.
+    """
+    nTokens = len(dataset.tokens())
+    ids = dataset.sentenceIds().astype(np.int64)
+    sentlengths = np.asarray(dataset._sentlengths)
+    cumsentlen = np.asarray(dataset._cumsentlen)
+    sentOf = np.repeat(np.arange(len(sentlengths)), sentlengths)
+
+    # Number of tokens per block so that one block yields <= maxEntries pairs
+    blockTokens = max(1, maxEntries // (2 * windowSize))
+
+    ownTmpdir = tmpdir is None
+    if ownTmpdir:
+        tmpdir = tempfile.mkdtemp(prefix="cooccurrence")
+
+    try:
+        chunkFiles = []
+        pendingKeys = []
+        pendingValues = []
+        pending = 0
+        start = 0
+        while start < len(ids):
+            # Cut blocks at sentence boundaries
+            end = cumsentlen[min(np.searchsorted(cumsentlen, start + blockTokens),
+                                 len(cumsentlen) - 1)]
+            keys, values = sumByKey(*windowPairs(
+                ids[start:end], sentOf[start:end], windowSize, nTokens))
+            pendingKeys += [keys]
+            pendingValues += [values]
+            pending += len(keys)
+            start = end
+
+            if pending > maxEntries or start >= len(ids):
+                keys, values = sumByKey(np.concatenate(pendingKeys),
+                                        np.concatenate(pendingValues))
+                chunkFiles += [spill(keys, values, tmpdir, len(chunkFiles))]
+                pendingKeys = []
+                pendingValues = []
+                pending = 0
+
+        if len(chunkFiles) == 1:
+            keys = np.load(chunkFiles[0][0])
+            values = np.load(chunkFiles[0][1])
+        else:
+            keys, values = mergeChunks(chunkFiles, maxEntries)
+    finally:
+        if ownTmpdir:
+            shutil.rmtree(tmpdir)
+
+    rows = (keys // nTokens).astype(np.int32)
+    cols = (keys % nTokens).astype(np.int32)
+    return sp.coo_matrix((values, (rows, cols)), shape=(nTokens, nTokens))
@@ -1,22 +1,88 @@
 
 import numpy as np
+import scipy.sparse as sp
+
+import embedding_store
 
 DEFAULT_FILE_PATH = "utils/datasets/glove.6B.50d.txt"
 
 def loadWordVectors(tokens, filepath=DEFAULT_FILE_PATH, dimensions=50):
     """Read pretrained GloVe vectors"""
-    wordVectors = np.zeros((len(tokens), dimensions))
-    with open(filepath) as ifs:
-        for line in ifs:
-            line = line.strip()
-            if not line:
-                continue
-            row = line.split()
-            token = row[0]
-            if token not in tokens:
-                continue
-            data = [float(x) for x in row[1:]]
-            if len(data) != dimensions:
-                raise RuntimeError("wrong number of dimensions")
-            wordVectors[tokens[token]] = np.asarray(data)
-    return wordVectors
+    wv, words = embedding_store.load(filepath)
+    if wv.shape[1] != dimensions:
+        raise RuntimeError("wrong number of dimensions")
+    return embedding_store.extract(wv, embedding_store.word_index(words), tokens)
+
+
+def adagradUpdate(params, gradsq, idx, grad, step):
+    """
+    Apply one AdaGrad step to the rows idx of params. Gradients for rows
+    that occur several times in idx are summed before the update.
+    """
+    rows, inverse = np.unique(idx, return_inverse=True)
+    gather = sp.csr_matrix((np.ones(len(idx)), (inverse, np.arange(len(idx)))),
+                           shape=(len(rows), len(idx)))
+    grad = gather.dot(grad)
+    gradsq[rows] += grad ** 2
+    params[rows] -= step * grad / np.sqrt(gradsq[rows])
+
+
+def trainGloVe(cooc, dimensions=10, epochs=25, step=0.05, xMax=100.0,
+               alpha=0.75, batchsize=4096, PRINT_EVERY=1):
+    """ Train GloVe vectors with AdaGrad
+
+    Each epoch makes one pass over the nonzero co-occurrence counts in
+    shuffled minibatches, minimizing
+        sum f(X_ij) (w_i . w~_j + b_i + b~_j - log X_ij)^2
+    with f(x) = min(1, (x / xMax) ** alpha).
+
+    Arguments:
+    cooc -- (nTokens, nTokens) scipy.sparse co-occurrence matrix, e.g. from
+            utils.cooccurrence.cooccurrenceCounts
+    dimensions -- size of the word vectors
+    epochs -- passes over the nonzero entries
+    step -- AdaGrad learning rate
+
+    Return:
+    wordVectors -- (2 * nTokens, dimensions) array holding the word vectors
+                   w followed by the context vectors w~, the same layout
+                   as the word2vec parameters trained in q3_run.py
+    """
+    cooc = cooc.tocoo()
+    nTokens = cooc.shape[0]
+    rows = cooc.row
+    cols = cooc.col
+    logCounts = np.log(cooc.data)
+    weights = np.minimum(1.0, (cooc.data / xMax) ** alpha)
+
+    W = (np.random.rand(nTokens, dimensions) - 0.5) / dimensions
+    Wc = (np.random.rand(nTokens, dimensions) - 0.5) / dimensions
+    b = np.zeros((nTokens, 1))
+    bc = np.zeros((nTokens, 1))
+    # Start the squared gradient sums at one, as the reference GloVe does
+    gradsq = [np.ones_like(p) for p in (W, Wc, b, bc)]
+
+    for epoch in xrange(1, epochs + 1):
+        cost = 0.0
+        order = np.random.permutation(len(logCounts))
+        for start in xrange(0, len(order), batchsize):
+            batch = order[start:start + batchsize]
+            i = rows[batch]
+            j = cols[batch]
+
+            diff = (np.sum(W[i] * Wc[j], axis=1) + b[i, 0] + bc[j, 0]
+                    - logCounts[batch])
+            fdiff = weights[batch] * diff
+            cost += 0.5 * np.sum(fdiff * diff)
+
+            gradW = fdiff[:, np.newaxis] * Wc[j]
+            gradWc = fdiff[:, np.newaxis] * W[i]
+            adagradUpdate(W, gradsq[0], i, gradW, step)
+            adagradUpdate(Wc, gradsq[1], j, gradWc, step)
+            adagradUpdate(b, gradsq[2], i, fdiff[:, np.newaxis], step)
+            adagradUpdate(bc, gradsq[3], j, fdiff[:, np.newaxis], step)
+
+        if epoch % PRINT_EVERY == 0:
+            print "epoch %d: %f" % (epoch, cost / len(logCounts))
+
+    return np.concatenate((W, Wc), axis=0)
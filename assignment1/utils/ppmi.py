@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+import numpy as np
+import scipy.sparse as sp
+
+from cooccurrence import cooccurrenceCounts
+
+
+def ppmiMatrix(cooc, alpha=0.75):
+    """
+    Positive pointwise mutual information of a co-occurrence matrix,
+        PPMI(w, c) = max(0, log(P(w, c) / (P(w) P_alpha(c))))
+    where the context distribution is smoothed by raising counts to the
+    power alpha. Only nonzero counts are visited, so the result is as
+    sparse as cooc.
+    """
+    cooc = sp.csr_matrix(cooc)
+    # P(w) = wordCounts / total cancels the total in P(w, c)
+    wordCounts = np.asarray(cooc.sum(axis=1)).ravel()
+    contextCounts = np.asarray(cooc.sum(axis=0)).ravel() ** alpha
+    contextProb = contextCounts / contextCounts.sum()
+
+    coo = cooc.tocoo()
+    pmi = np.log(coo.data / (wordCounts[coo.row] * contextProb[coo.col]))
+    keep = pmi > 0
+    return sp.csr_matrix((pmi[keep], (coo.row[keep], coo.col[keep])),
+                         shape=cooc.shape)
+
+
+def randomizedSvd(M, k, oversample=10, nIter=4):
+    """
+    Rank-k truncated SVD of a (sparse) matrix by randomized range finding
+    with nIter power iterations (Halko, Martinsson and Tropp, 2011).
+    """
+    Q = M.dot(np.random.randn(M.shape[1], k + oversample))
+    Q, _ = np.linalg.qr(Q)
+    for i in xrange(nIter):
+        Q, _ = np.linalg.qr(M.T.dot(Q))
+        Q, _ = np.linalg.qr(M.dot(Q))
+
+    B = M.T.dot(Q).T
+    Ub, S, Vt = np.linalg.svd(B, full_matrices=False)
+    return Q.dot(Ub[:, :k]), S[:k], Vt[:k]
+
+
+def ppmiVectors(dataset, dimensions=10, windowSize=5, alpha=0.75):
+    """
+    Count-based word vectors for a StanfordSentiment dataset.
+
+    Return:
+    wordVectors -- (2 * nTokens, dimensions) array holding the word vectors
+                   U * sqrt(S) followed by the context vectors V * sqrt(S),
+                   the same layout as the word2vec parameters trained in
+                   q3_run.py
+    """
+    M = ppmiMatrix(cooccurrenceCounts(dataset, windowSize), alpha)
+    U, S, Vt = randomizedSvd(M, dimensions)
+    scale = np.sqrt(S)
+    return np.concatenate((U * scale, Vt.T * scale), axis=0)
@@ -2,19 +2,83 @@
 # -*- coding: utf-8 -*-
 
 import cPickle as pickle
+import multiprocessing as mp
 import numpy as np
 import os
 import random
 
+# Binary cache of the parsed treebank, written next to the source files
+CACHE_FILE = "parsed.cache.npz"
+# Bump whenever the set of cached arrays changes
+CACHE_VERSION = 2
+SOURCE_FILES = ["datasetSentences.txt", "dictionary.txt",
+                "sentiment_labels.txt", "datasetSplit.txt"]
+
+# Upper bounds of the sentiment classes used by categorify
+CATEGORY_BOUNDS = np.array([0.2, 0.4, 0.6, 0.8])
+
+HASH_BASE = np.uint64(0x9E3779B97F4A7C15)
+MIX_A = np.uint64(0xBF58476D1CE4E5B9)
+MIX_B = np.uint64(0x94D049BB133111EB)
+
+def mix64(x):
+    """ splitmix64 finalizer, applied elementwise to a uint64 array """
+    x = x ^ (x >> np.uint64(30))
+    x = x * MIX_A
+    x = x ^ (x >> np.uint64(27))
+    x = x * MIX_B
+    return x ^ (x >> np.uint64(31))
+
+def hashSequences(ids, ends):
+    """
+    64-bit hashes of the integer sequences ids[ends[i-1]:ends[i]],
+    computed for all sequences at once.
+    """
+    ids = np.asarray(ids).astype(np.uint64)
+    ends = np.asarray(ends, dtype=np.int64)
+    starts = np.concatenate(([0], ends[:-1])).astype(np.int64)
+    lengths = ends - starts
+
+    with np.errstate(over="ignore"):
+        maxlen = max(int(lengths.max()) if len(lengths) else 0, 1)
+        powers = np.cumprod(np.concatenate(([np.uint64(1)],
+            np.repeat(HASH_BASE, maxlen - 1)))).astype(np.uint64)
+        positions = np.arange(len(ids)) - np.repeat(starts, lengths)
+        terms = mix64(ids + np.uint64(1)) * powers[positions]
+
+        hashes = np.zeros((len(ends),), dtype=np.uint64)
+        nonempty = lengths > 0
+        if len(ids):
+            hashes[nonempty] = np.add.reduceat(terms, starts[nonempty])
+        # Fold the length in as one more term so that it cannot cancel out
+        # against the token terms
+        return mix64(hashes * HASH_BASE + lengths.astype(np.uint64) + np.uint64(1))
+
+def normalizeWord(w):
+    """ Lowercase a word and undo the double encoding of datasetSentences.txt """
+    # Deal with some peculiar encoding issues with this file
+    return w.lower().decode("utf-8").encode('latin1')
+
+def tokenize(line):
+    """
+    Split a raw UTF-8 sentence into words. Only datasetSentences.txt is
+    double encoded, so raw text is just lowercased; its words then match
+    the words of sentences().
+    """
+    return line.lower().split()
+
 class StanfordSentiment:
-    def __init__(self, path=None, tablesize = 1000000):
+    def __init__(self, path=None, tablesize = 1000000, cache=True):
         if not path:
             path = "utils/datasets/stanfordSentimentTreebank"
 
         self.path = path
         self.tablesize = tablesize
+        self.cache = cache
+        self._cacheChecked = False
 
     def tokens(self):
+        self.loadCache()
         if hasattr(self, "_tokens") and self._tokens:
             return self._tokens
 
@@ -47,6 +111,7 @@ class StanfordSentiment:
         return self._tokens
 
     def sentences(self):
+        self.loadCache()
         if hasattr(self, "_sentences") and self._sentences:
             return self._sentences
 
@@ -59,8 +124,7 @@ class StanfordSentiment:
                     continue
 
                 splitted = line.strip().split()[1:]
-                # Deal with some peculiar encoding issues with this file
-                sentences += [[w.lower().decode("utf-8").encode('latin1') for w in splitted]]
+                sentences += [[normalizeWord(w) for w in splitted]]
 
         self._sentences = sentences
         self._sentlengths = np.array([len(s) for s in sentences])
@@ -111,20 +175,27 @@ class StanfordSentiment:
             return self.getRandomContext(C)
 
     def sent_labels(self):
+        self.loadCache()
         if hasattr(self, "_sent_labels") and self._sent_labels:
             return self._sent_labels
 
-        dictionary = dict()
-        phrases = 0
-        with open(self.path + "/dictionary.txt", "r") as f:
-            for line in f:
-                line = line.strip()
-                if not line: continue
-                splitted = line.split("|")
-                dictionary[splitted[0].lower()] = int(splitted[1])
-                phrases += 1
+        sentIds = self.sentenceIds()
+        phraseIds = self.lookupPhraseIds(sentIds, self._cumsentlen)
+        if np.any(phraseIds < 0):
+            missing = int(np.flatnonzero(phraseIds < 0)[0])
+            raise KeyError(" ".join(self.sentences()[missing]))
+
+        self._sent_labels = self.phrase_labels()[phraseIds].tolist()
+        return self._sent_labels
 
-        labels = [0.0] * phrases
+    def phrase_labels(self):
+        """ Sentiment label of every treebank phrase, indexed by phrase id """
+        self.loadCache()
+        if hasattr(self, "_phrase_labels") and self._phrase_labels is not None:
+            return self._phrase_labels
+
+        phraseIds = []
+        labels = []
         with open(self.path + "/sentiment_labels.txt", "r") as f:
             first = True
             for line in f:
@@ -135,19 +206,86 @@ class StanfordSentiment:
                 line = line.strip()
                 if not line: continue
                 splitted = line.split("|")
-                labels[int(splitted[0])] = float(splitted[1])
+                phraseIds += [int(splitted[0])]
+                labels += [float(splitted[1])]
+
+        phrase_labels = np.zeros((max(phraseIds) + 1,))
+        phrase_labels[phraseIds] = labels
+
+        self._phrase_labels = phrase_labels
+        return self._phrase_labels
+
+    def phraseIndex(self):
+        """
+        Compact index of dictionary.txt: the sorted 64-bit hashes of every
+        phrase as a sequence of token ids, and the matching phrase ids.
+        Phrases with words that never occur in a sentence cannot be looked
+        up by token ids and are left out.
+        """
+        self.loadCache()
+        if hasattr(self, "_phraseHashes") and self._phraseHashes is not None:
+            return self._phraseHashes, self._phraseIds
 
-        sent_labels = [0.0] * self.numSentences()
-        sentences = self.sentences()
-        for i in xrange(self.numSentences()):
-            sentence = sentences[i]
-            full_sent = " ".join(sentence).replace('-lrb-', '(').replace('-rrb-', ')')
-            sent_labels[i] = labels[dictionary[full_sent]]
+        tokens = self.tokens()
+        ids = []
+        ends = []
+        phraseIds = []
+        with open(self.path + "/dictionary.txt", "r") as f:
+            for line in f:
+                line = line.strip()
+                if not line: continue
+                splitted = line.split("|")
+                # Sentences spell brackets the PTB way
+                words = splitted[0].lower().replace("(", "-lrb-").replace(
+                    ")", "-rrb-").split(" ")
+                wordIds = [tokens.get(w, -1) for w in words]
+                if -1 in wordIds: continue
+                ids += wordIds
+                ends += [len(ids)]
+                phraseIds += [int(splitted[1])]
+
+        hashes = hashSequences(np.array(ids, dtype=np.int64), ends)
+
+        # Later entries win over earlier duplicates, as they did in a dict
+        order = np.argsort(hashes, kind="mergesort")
+        hashes = hashes[order]
+        last = np.append(hashes[1:] != hashes[:-1], True)
+
+        self._phraseHashes = hashes[last]
+        self._phraseIds = np.array(phraseIds, dtype=np.int32)[order[last]]
+        return self._phraseHashes, self._phraseIds
+
+    def lookupPhraseIds(self, ids, ends):
+        """
+        Bulk phrase lookup. The token-id sequences to look up are given as
+        one flat array ids, sequence i ending at ends[i]. Returns the
+        phrase id of every sequence, or -1 if it is not a treebank phrase.
+        """
+        hashes, phraseIds = self.phraseIndex()
+        queries = hashSequences(ids, ends)
+        pos = np.minimum(np.searchsorted(hashes, queries), len(hashes) - 1)
+        return np.where(hashes[pos] == queries, phraseIds[pos], -1)
+
+    def lookupPhrases(self, phrases):
+        """
+        Phrase ids for a list of phrases, each a list of lowercase words as
+        in sentences(); -1 for phrases that are not in the treebank.
+        """
+        tokens = self.tokens()
+        ids = [tokens.get(w, -1) for phrase in phrases for w in phrase]
+        ends = np.cumsum([len(phrase) for phrase in phrases])
+        ids = np.array(ids, dtype=np.int64)
 
-        self._sent_labels = sent_labels
-        return self._sent_labels
+        # Unknown words would all hash alike, so they can never match
+        unknown = np.zeros((len(phrases),), dtype=bool)
+        unknown[np.searchsorted(ends, np.flatnonzero(ids < 0), side="right")] = True
+
+        phraseIds = self.lookupPhraseIds(np.maximum(ids, 0), ends)
+        phraseIds[unknown] = -1
+        return phraseIds
 
     def dataset_split(self):
+        self.loadCache()
         if hasattr(self, "_split") and self._split:
             return self._split
 
@@ -168,7 +306,7 @@ class StanfordSentiment:
     def getRandomTrainSentence(self):
         split = self.dataset_split()
         sentId = split[0][random.randint(0, len(split[0]) - 1)]
-        return self.sentences()[sentId], self.categorify(self.sent_labels()[sentId])
+        return self.sentences()[sentId], int(self.sent_categories()[sentId])
 
     def categorify(self, label):
         if label <= 0.2:
@@ -182,6 +320,15 @@ class StanfordSentiment:
         else:
             return 4
 
+    def sent_categories(self):
+        """ Vectorized categorify over all sentence labels """
+        if hasattr(self, "_sent_categories") and self._sent_categories is not None:
+            return self._sent_categories
+
+        self._sent_categories = np.searchsorted(
+            CATEGORY_BOUNDS, self.sent_labels()).astype(np.int8)
+        return self._sent_categories
+
     def getDevSentences(self):
         return self.getSplitSentences(2)
 
@@ -193,40 +340,51 @@ class StanfordSentiment:
 
     def getSplitSentences(self, split=0):
         ds_split = self.dataset_split()
-        return [(self.sentences()[i], self.categorify(self.sent_labels()[i])) for i in ds_split[split]]
+        sentences = self.sentences()
+        categories = self.sent_categories()
+        return [(sentences[i], int(categories[i])) for i in ds_split[split]]
 
     def sampleTable(self):
         if hasattr(self, '_sampleTable') and self._sampleTable is not None:
             return self._sampleTable
 
-        nTokens = len(self.tokens())
-        samplingFreq = np.zeros((nTokens,))
+        self.tokens()
         self.allSentences()
-        i = 0
-        for w in xrange(nTokens):
-            w = self._revtokens[i]
-            if w in self._tokenfreq:
-                freq = 1.0 * self._tokenfreq[w]
-                # Reweigh
-                freq = freq ** 0.75
-            else:
-                freq = 0.0
-            samplingFreq[i] = freq
-            i += 1
+        samplingFreq = np.array([self._tokenfreq[w] for w in self._revtokens],
+                                dtype=np.float64)
+        # Reweigh
+        samplingFreq **= 0.75
 
         samplingFreq /= np.sum(samplingFreq)
         samplingFreq = np.cumsum(samplingFreq) * self.tablesize
 
-        self._sampleTable = [0] * self.tablesize
-
-        j = 0
-        for i in xrange(self.tablesize):
-            while i > samplingFreq[j]:
-                j += 1
-            self._sampleTable[i] = j
+        # Entry i holds the first token whose cumulative frequency reaches i
+        self._sampleTable = np.minimum(
+            np.searchsorted(samplingFreq, np.arange(self.tablesize)),
+            len(samplingFreq) - 1).astype(np.int32)
 
         return self._sampleTable
 
+    def shareSampleTable(self):
+        """
+        Move the sample table into shared memory and return the RawArray
+        holding it. Worker processes pass it to attachSampleTable, so that
+        they all read one table instead of each building their own.
+        """
+        if hasattr(self, '_sharedTable') and self._sharedTable is not None:
+            return self._sharedTable
+
+        table = self.sampleTable()
+        self._sharedTable = mp.RawArray("i", self.tablesize)
+        self._sampleTable = np.frombuffer(self._sharedTable, dtype=np.int32)
+        self._sampleTable[:] = table
+        return self._sharedTable
+
+    def attachSampleTable(self, sharedTable):
+        """ Use a sample table shared by shareSampleTable in another process """
+        self._sharedTable = sharedTable
+        self._sampleTable = np.frombuffer(sharedTable, dtype=np.int32)
+
     def rejectProb(self):
         if hasattr(self, '_rejectProb') and self._rejectProb is not None:
             return self._rejectProb
@@ -244,5 +402,135 @@ class StanfordSentiment:
         self._rejectProb = rejectProb
         return self._rejectProb
 
-    def sampleTokenIdx(self):
-        return self.sampleTable()[random.randint(0, self.tablesize - 1)]
\ No newline at end of file
+    def sampleTokenIdx(self, n=None):
+        """
+        Draw one token index, or an array of n indices when n is given.
+        """
+        if n is None:
+            return int(self.sampleTable()[random.randint(0, self.tablesize - 1)])
+        return self.sampleTable()[np.random.randint(0, self.tablesize, size=n)]
+
+    def cachePath(self):
+        return self.path + "/" + CACHE_FILE
+
+    def sourceSignature(self):
+        """ Size and mtime of every source file, used to invalidate the cache """
+        signature = []
+        for name in SOURCE_FILES:
+            st = os.stat(self.path + "/" + name)
+            signature += [[st.st_size, st.st_mtime]]
+        return np.array(signature, dtype=np.float64)
+
+    def loadCache(self):
+        """
+        Restore the parsed dataset from the binary cache, (re)building the
+        cache first when it is missing or older than the source files.
+        """
+        if not self.cache or self._cacheChecked:
+            return
+        self._cacheChecked = True
+
+        signature = self.sourceSignature()
+        if os.path.exists(self.cachePath()):
+            cached = np.load(self.cachePath())
+            if ("version" in cached.files
+                    and int(cached["version"]) == CACHE_VERSION
+                    and np.array_equal(cached["signature"], signature)):
+                self.restoreCache(cached)
+                return
+
+        self.saveCache(signature)
+
+    def restoreCache(self, cached):
+        revtokens = cached["revtokens"].tolist()
+        tokenfreq = cached["tokenfreq"].tolist()
+        sentIds = cached["sentIds"]
+        cumsentlen = cached["cumsentlen"]
+
+        self._revtokens = revtokens
+        self._tokens = dict(zip(revtokens, xrange(len(revtokens))))
+        self._tokenfreq = dict(zip(revtokens, tokenfreq))
+        self._wordcount = int(cached["wordcount"])
+
+        starts = np.concatenate(([0], cumsentlen[:-1]))
+        self._sentIds = sentIds
+        self._sentlengths = cumsentlen - starts
+        self._cumsentlen = cumsentlen
+        words = [revtokens[i] for i in sentIds.tolist()]
+        self._sentences = [words[start:end]
+            for start, end in zip(starts.tolist(), cumsentlen.tolist())]
+        self._numSentences = len(self._sentences)
+
+        self._sent_labels = cached["sentLabels"].tolist()
+        self._phrase_labels = cached["phraseLabels"]
+        self._phraseHashes = cached["phraseHashes"]
+        self._phraseIds = cached["phraseIds"]
+        self._sent_categories = cached["sentCategories"]
+
+        splitSents = cached["splitSents"].tolist()
+        splitEnds = np.cumsum(cached["splitLens"]).tolist()
+        self._split = [splitSents[start:end]
+            for start, end in zip([0] + splitEnds[:-1], splitEnds)]
+
+    def saveCache(self, signature):
+        self.tokens()
+        split = self.dataset_split()
+        sentIds = self.sentenceIds()
+        phraseHashes, phraseIds = self.phraseIndex()
+        tmpPath = self.cachePath() + ".tmp"
+        try:
+            with open(tmpPath, "wb") as f:
+                np.savez(f,
+                    version=CACHE_VERSION,
+                    signature=signature,
+                    revtokens=np.array(self._revtokens),
+                    tokenfreq=np.array([self._tokenfreq[w]
+                        for w in self._revtokens], dtype=np.int64),
+                    wordcount=self._wordcount,
+                    sentIds=sentIds,
+                    cumsentlen=self._cumsentlen,
+                    sentLabels=np.array(self.sent_labels()),
+                    sentCategories=self.sent_categories(),
+                    phraseLabels=self.phrase_labels(),
+                    phraseHashes=phraseHashes,
+                    phraseIds=phraseIds,
+                    splitSents=np.array(sum(split, []), dtype=np.int32),
+                    splitLens=np.array([len(s) for s in split]))
+            os.rename(tmpPath, self.cachePath())
+        except (IOError, OSError):
+            # A read-only dataset directory just means we parse every time
+            pass
+
+    def sentenceIds(self):
+        """
+        All sentences as one flat array of token ids; sentence i spans
+        [_cumsentlen[i] - _sentlengths[i], _cumsentlen[i]).
+        """
+        if hasattr(self, "_sentIds") and self._sentIds is not None:
+            return self._sentIds
+
+        tokens = self.tokens()
+        self._sentIds = np.array([tokens[w] for s in self.sentences()
+            for w in s], dtype=np.int32)
+        return self._sentIds
+
+
+def sanity_check():
+    """
+    Run python -m utils.treebank.
+    """
+    print "Running sanity checks..."
+    assert normalizeWord("Caf\xc3\x83\xc2\xa9") == "caf\xc3\xa9"
+    assert tokenize("  Caf\xc3\xa9 NOIR\n") == ["caf\xc3\xa9", "noir"]
+
+    # Every non-ASCII word of the dataset, as raw uppercase UTF-8 text,
+    # tokenizes back to itself
+    tokens = StanfordSentiment().tokens()
+    nonAscii = [w for w in tokens if any(ord(c) > 127 for c in w)]
+    for w in nonAscii:
+        assert tokenize(w.upper()) == [w]
+    print "%d non-ASCII words tokenize to their dataset form" % len(nonAscii)
+
+
+if __name__ == "__main__":
+    sanity_check()
@@ -0,0 +1,33 @@
+##
+# On-disk caches of preprocessed data
+#
+# A cache is a set of files plus a signature file holding a key computed
+# from everything the cached data depends on (see cache_key). The
+# signature is written only after all the other files, so an interrupted
+# run leaves no valid-looking cache, and a changed key rebuilds it.
+##
+
+import hashlib
+import os
+
+
+def file_signature(fname):
+    """Size and modification time of a source file."""
+    st = os.stat(fname)
+    return "%d:%r" % (st.st_size, st.st_mtime)
+
+def cache_key(*parts):
+    """Digest of the reprs of parts, e.g. file signatures and settings."""
+    return hashlib.md5(repr(parts)).hexdigest()
+
+def cache_valid(sigfile, key, files):
+    """True if every file of the cache exists and sigfile holds key."""
+    if not all(map(os.path.exists, files + [sigfile])):
+        return False
+    with open(sigfile) as fd:
+        return fd.read() == key
+
+def write_signature(sigfile, key):
+    """Mark a cache valid; call once all its other files are written."""
+    with open(sigfile, "w") as fd:
+        fd.write(key)
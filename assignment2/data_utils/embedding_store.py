@@ -0,0 +1,114 @@
+##
+# Binary store for pretrained word vectors
+#
+# A text embedding file is parsed once and written next to it as
+# <wvfile>.npy (the vector matrix, memory-mappable) and <wvfile>.vocab
+# (one word per line, row order). Later loads map the matrix instead of
+# parsing text, and the store is rebuilt when the text file changes.
+#
+# The two assignments are self-contained and never import each other, so
+# this module is kept in both as an identical copy: change
+# assignment1/utils/embedding_store.py and
+# assignment2/data_utils/embedding_store.py together.
+##
+
+import os
+
+import numpy as np
+
+
+def store_paths(wvfile):
+    return wvfile + ".npy", wvfile + ".vocab"
+
+def is_stale(wvfile, vocabfile=None):
+    """True if the binary store is missing or older than its sources."""
+    npyfile, storevocab = store_paths(wvfile)
+    if not (os.path.exists(npyfile) and os.path.exists(storevocab)):
+        return True
+    built = min(os.path.getmtime(npyfile), os.path.getmtime(storevocab))
+    sources = [wvfile] if vocabfile is None else [wvfile, vocabfile]
+    return any(os.path.getmtime(f) > built for f in sources)
+
+def parse_text(wvfile, vocabfile=None, dtype=np.float64):
+    """
+    Parse text vectors. Without vocabfile each line is "word v1 ... vD"
+    (GloVe format); with it, wvfile holds only the numbers and vocabfile
+    the words, one per line.
+
+    The file is read twice: once to count the rows, then to parse each
+    line straight into a preallocated matrix, so no per-number strings are
+    held in memory.
+    """
+    with open(wvfile) as fd:
+        nrows = sum(1 for line in fd if line.strip())
+    wv = None
+    words = []
+    with open(wvfile) as fd:
+        i = 0
+        for line in fd:
+            if not line.strip():
+                continue
+            if vocabfile is None:
+                fields = line.split(None, 1)
+                words.append(fields[0])
+                line = fields[1] if len(fields) > 1 else ""
+            row = np.fromstring(line, dtype=dtype, sep=" ")
+            if wv is None:
+                wv = np.empty((nrows, len(row)), dtype=dtype)
+            if len(row) != wv.shape[1]:
+                raise RuntimeError("wrong number of dimensions in %s" % wvfile)
+            wv[i] = row
+            i += 1
+    if vocabfile is not None:
+        with open(vocabfile) as fd:
+            words = [line.strip() for line in fd]
+    if wv is None:
+        wv = np.zeros((0, 0), dtype=dtype)
+    return wv, words
+
+def convert(wvfile, vocabfile=None, dtype=np.float64):
+    """Write the binary store for a text embedding file."""
+    wv, words = parse_text(wvfile, vocabfile, dtype)
+    npyfile, storevocab = store_paths(wvfile)
+    # Write under temporary names so readers never see a partial store
+    with open(npyfile + ".tmp", "wb") as fd:
+        np.save(fd, wv)
+    with open(storevocab + ".tmp", "w") as fd:
+        fd.write("\n".join(words))
+    os.rename(npyfile + ".tmp", npyfile)
+    os.rename(storevocab + ".tmp", storevocab)
+
+def load(wvfile, vocabfile=None, mmap_mode="r"):
+    """
+    Return (wv, words) for a text embedding file, converting it to the
+    binary store on first use. wv is memory-mapped unless mmap_mode is
+    None. If the store cannot be written, e.g. next to a read-only file,
+    the text is parsed into memory instead.
+    """
+    if is_stale(wvfile, vocabfile):
+        try:
+            convert(wvfile, vocabfile)
+        except (IOError, OSError):
+            return parse_text(wvfile, vocabfile)
+    npyfile, storevocab = store_paths(wvfile)
+    wv = np.load(npyfile, mmap_mode=mmap_mode)
+    with open(storevocab) as fd:
+        words = fd.read().split("\n")
+    return wv, words
+
+def word_index(words):
+    """Map each word to its row; later duplicates win, like a text scan."""
+    return dict(zip(words, xrange(len(words))))
+
+def extract(wv, word_to_num, tokens):
+    """
+    Bulk subset: a (len(tokens), D) matrix whose row tokens[w] is the
+    vector of w, or zeros for words without a vector.
+    """
+    out = np.zeros((len(tokens), wv.shape[1]), dtype=wv.dtype)
+    pairs = [(i, word_to_num[w]) for w, i in tokens.iteritems()
+             if w in word_to_num]
+    if pairs:
+        rows, src = zip(*pairs)
+        out[list(rows)] = wv[list(src)]
+    return out
@@ -5,11 +5,10 @@
 
 from utils import invert_dict
 from numpy import *
+import embedding_store
 
 def load_wv(vocabfile, wvfile):
-    wv = loadtxt(wvfile, dtype=float)
-    with open(vocabfile) as fd:
-        words = [line.strip() for line in fd]
+    wv, words = embedding_store.load(wvfile, vocabfile)
     num_to_word = dict(enumerate(words))
     word_to_num = invert_dict(num_to_word)
     return wv, word_to_num, num_to_word
@@ -0,0 +1,122 @@
+##
+# Evaluation of NER tag predictions
+#
+# NEREvaluator accumulates a confusion matrix and entity span counts batch
+# by batch, so predictions can be scored while they are produced. Tags are
+# indices; an entity is a maximal run of tokens with the same tag other
+# than the outside tag (O), not crossing a sentence start.
+##
+
+from numpy import *
+
+
+def confusion_matrix(y_true, y_pred, num_tags):
+    """Counts of (true, predicted) tag pairs, true tags along the rows."""
+    pairs = asarray(y_true, dtype=int64) * num_tags + asarray(y_pred)
+    counts = bincount(pairs, minlength=num_tags * num_tags)
+    return counts.reshape(num_tags, num_tags)
+
+def precision_recall_f1(confusion):
+    """Per-tag precision, recall and F1 arrays of a confusion matrix."""
+    correct = diag(confusion).astype(float64)
+    with errstate(divide="ignore", invalid="ignore"):
+        precision = correct / confusion.sum(axis=0)
+        recall = correct / confusion.sum(axis=1)
+        f1 = 2 * precision * recall / (precision + recall)
+    return precision, recall, f1
+
+def run_starts(tags, starts=None):
+    """Boolean mask of the positions where a new run of tags begins."""
+    begin = ones(len(tags), dtype=bool)
+    begin[1:] = tags[1:] != tags[:-1]
+    if starts is not None:
+        begin |= starts
+    return begin
+
+def spans(tags, begin, outside=0):
+    """(start, end, tag) arrays of the entity spans, given run_starts."""
+    first = flatnonzero(begin)
+    end = append(first[1:], len(tags))
+    keep = tags[first] != outside
+    return first[keep], end[keep], tags[first][keep]
+
+def f1_score(precision, recall):
+    if precision + recall == 0:
+        return 0.0
+    return 2 * precision * recall / (precision + recall)
+
+
+class NEREvaluator(object):
+    """Streaming token- and entity-level evaluation of tag predictions."""
+
+    def __init__(self, num_tags, outside=0):
+        self.num_tags = num_tags
+        self.outside = outside
+        self.confusion = zeros((num_tags, num_tags), dtype=int64)
+        # Entity spans per tag: true, predicted and predicted exactly
+        self.true_spans = zeros(num_tags, dtype=int64)
+        self.pred_spans = zeros(num_tags, dtype=int64)
+        self.correct_spans = zeros(num_tags, dtype=int64)
+        # Tokens whose spans may continue into the next batch
+        self.pending = (zeros(0, dtype=int64), zeros(0, dtype=int64),
+                        zeros(0, dtype=bool))
+
+    def update(self, y_true, y_pred, starts=None):
+        """
+        Add a batch of true and predicted tags. starts optionally marks
+        the tokens that begin a sentence.
+        """
+        y_true = asarray(y_true, dtype=int64)
+        y_pred = asarray(y_pred, dtype=int64)
+        self.confusion += confusion_matrix(y_true, y_pred, self.num_tags)
+        if starts is None:
+            starts = zeros(len(y_true), dtype=bool)
+        pending = [concatenate((p, new)) for p, new in
+                   zip(self.pending, (y_true, y_pred, asarray(starts)))]
+        # Spans are only counted before the last position where both tag
+        # sequences begin a run: no span crosses it, but the runs after it
+        # may go on in the next batch
+        begin_true = run_starts(pending[0], pending[2])
+        begin_pred = run_starts(pending[1], pending[2])
+        both = flatnonzero(begin_true & begin_pred)
+        cut = both[-1] if len(both) > 0 else 0
+        self.count_spans(pending[0][:cut], pending[1][:cut],
+                         begin_true[:cut], begin_pred[:cut])
+        self.pending = tuple(p[cut:] for p in pending)
+
+    def finish(self):
+        """Count the spans still pending at the end of the data."""
+        y_true, y_pred, starts = self.pending
+        self.count_spans(y_true, y_pred, run_starts(y_true, starts),
+                         run_starts(y_pred, starts))
+        self.pending = tuple(p[:0] for p in self.pending)
+
+    def count_spans(self, y_true, y_pred, begin_true, begin_pred):
+        true = spans(y_true, begin_true, self.outside)
+        pred = spans(y_pred, begin_pred, self.outside)
+        self.true_spans += bincount(true[2], minlength=self.num_tags)
+        self.pred_spans += bincount(pred[2], minlength=self.num_tags)
+        # Encode each span as one integer to match them up
+        size = len(y_true) + 1
+        keys = [(s * size + e) * self.num_tags + t for s, e, t in (true, pred)]
+        matched = intersect1d(keys[0], keys[1]) % self.num_tags
+        self.correct_spans += bincount(matched, minlength=self.num_tags)
+
+    def token_scores(self):
+        """Per-tag token precision, recall and F1."""
+        return precision_recall_f1(self.confusion)
+
+    def entity_scores(self):
+        """Per-tag entity precision, recall and F1."""
+        with errstate(divide="ignore", invalid="ignore"):
+            precision = self.correct_spans / self.pred_spans.astype(float64)
+            recall = self.correct_spans / self.true_spans.astype(float64)
+            f1 = 2 * precision * recall / (precision + recall)
+        return precision, recall, f1
+
+    def entity_f1(self):
+        """Micro-averaged entity precision, recall and F1 over all tags."""
+        correct = float(self.correct_spans.sum())
+        precision = correct / max(self.pred_spans.sum(), 1)
+        recall = correct / max(self.true_spans.sum(), 1)
+        return precision, recall, f1_score(precision, recall)
@@ -3,9 +3,13 @@ import itertools
 from collections import Counter
 import time
 from numpy import *
+from numpy.lib.stride_tricks import as_strided
 
 import pandas as pd
 
+import embedding_store
+from cache import cache_key, cache_valid, file_signature, write_signature
+
 
 def invert_dict(d):
     return {v:k for k,v in d.iteritems()}
@@ -37,13 +41,26 @@ def canonicalize_word(word, wordset=None, digits=True):
     if (wordset == None) or (word in wordset): return word
     else: return "UUUNKKK" # unknown token
 
+def unique_map(items, fn):
+    """Array of fn(x) for each x in items, calling fn once per distinct x."""
+    if len(items) == 0:
+        return array([])
+    uniq, inverse = unique(array(items), return_inverse=True)
+    return array([fn(x) for x in uniq])[inverse]
+
+def canonicalize_words(words, wordset=None, digits=True):
+    """canonicalize_word over a sequence, computed once per word type."""
+    return unique_map(words, lambda w: canonicalize_word(w, wordset, digits))
+
 
 ##
 # Utility functions used to create dataset
 ##
 def augment_wv(df, extra=["UUUNKKK"]):
-    for e in extra:
-        df.loc[e] = zeros(len(df.columns))
+    """Return a copy of df with a zero vector for each word in extra."""
+    zero_rows = pd.DataFrame(zeros((len(extra), len(df.columns))),
+                             index=extra, columns=df.columns)
+    return pd.concat([df.drop([e for e in extra if e in df.index]), zero_rows])
 
 def prune_wv(df, vocab, extra=["UUUNKKK"]):
     """Prune word vectors to vocabulary."""
@@ -51,10 +68,12 @@ def prune_wv(df, vocab, extra=["UUUNKKK"]):
     return df.filter(items=items, axis='index')
 
 def load_wv_raw(fname):
-    return pd.read_table(fname, sep="\s+",
-                         header=None,
-                         index_col=0,
-                         quoting=3)
+    wv, words = embedding_store.load(fname)
+    return pd.DataFrame(wv, index=words, columns=range(1, wv.shape[1] + 1))
+
+def is_docstart(line):
+    """Same test as re.match(r"-DOCSTART-.+", line), without the regex."""
+    return line.startswith("-DOCSTART-") and line[10:11] not in ("", "\n")
 
 def load_dataset(fname):
     docs = []
@@ -62,7 +81,7 @@ def load_dataset(fname):
         cur = []
         for line in fd:
             # new sentence on -DOCSTART- or blank line
-            if re.match(r"-DOCSTART-.+", line) or (len(line.strip()) == 0):
+            if is_docstart(line) or (len(line.strip()) == 0):
                 if len(cur) > 0:
                     docs.append(cur)
                 cur = []
@@ -72,6 +91,36 @@ def load_dataset(fname):
         docs.append(cur)
     return docs
 
+def read_conll(fname):
+    """
+    Stream a CoNLL file into flat lists of words and tags, with the
+    sentence boundaries as offsets: sentence s is words[offsets[s]:
+    offsets[s+1]]. Sentences are split as in load_dataset.
+    """
+    words = []
+    tags = []
+    offsets = [0]
+    with open(fname) as fd:
+        for line in fd:
+            stripped = line.strip()
+            if stripped and not is_docstart(line):
+                word, tag = stripped.split("\t", 1)
+                words.append(word)
+                tags.append(tag)
+            elif len(words) > offsets[-1]:
+                offsets.append(len(words))
+    if len(words) > offsets[-1]:
+        offsets.append(len(words))
+    return words, tags, array(offsets)
+
+def conll_to_ids(fname, word_to_num, tag_to_num):
+    """Canonicalized word ids, tag ids and sentence offsets of a CoNLL file."""
+    words, tags, offsets = read_conll(fname)
+    canonical = lambda w: word_to_num[canonicalize_word(w, word_to_num)]
+    ids = unique_map(words, canonical).astype(int32)
+    tag_ids = unique_map(tags, lambda t: tag_to_num[t.split("|")[0]])
+    return ids, tag_ids.astype(int32), offsets
+
 def extract_tag_set(docs):
     tags = set(flatten1([[t[1].split("|")[0] for t in d] for d in docs]))
     return tags
@@ -85,54 +134,108 @@ def pad_sequence(seq, left=1, right=1):
 
 ##
 # For window models
+def window_ids(ids, centers, left=1, right=1):
+    """
+    Rows ids[i-left:i+right+1] for each center i, gathered from a strided
+    view of ids instead of built one by one. As with list indexing,
+    positions before the start wrap around to the end.
+    """
+    ids = asarray(ids)
+    centers = asarray(centers)
+    n = len(ids)
+    if len(centers) > 0 and centers.max() + right >= n:
+        raise IndexError("window extends past the end of the sequence")
+    ext = concatenate((ids[n - left:], ids)) if left > 0 else ids
+    # Row i of the view is ext[i:i+left+right+1] = ids[i-left:i+right+1]
+    windows = as_strided(ext, shape=(max(n - right, 0), left + right + 1),
+                         strides=(ext.strides[0], ext.strides[0]))
+    return windows[centers]
+
 def seq_to_windows(words, tags, word_to_num, tag_to_num, left=1, right=1):
-    ns = len(words)
-    X = []
-    y = []
-    for i in range(ns):
-        if words[i] == "<s>" or words[i] == "</s>":
-            continue # skip sentence delimiters
-        tagn = tag_to_num[tags[i]]
-        idxs = [word_to_num[words[ii]]
-                for ii in range(i - left, i + right + 1)]
-        X.append(idxs)
-        y.append(tagn)
-    return array(X), array(y)
+    words = array(words)
+    centers = flatnonzero((words != "<s>") & (words != "</s>")) # skip sentence delimiters
+    ids = unique_map(words, word_to_num.__getitem__).astype(int32)
+    X = window_ids(ids, centers, left, right)
+    y = unique_map(array(tags)[centers], tag_to_num.__getitem__).astype(int32)
+    return X, y
 
 def docs_to_windows(docs, word_to_num, tag_to_num, wsize=3):
     pad = (wsize - 1)/2
     docs = flatten1([pad_sequence(seq, left=pad, right=pad) for seq in docs])
 
     words, tags = zip(*docs)
-    words = [canonicalize_word(w, word_to_num) for w in words]
-    tags = [t.split("|")[0] for t in tags]
+    words = canonicalize_words(words, word_to_num)
+    tags = unique_map(tags, lambda t: t.split("|")[0])
     return seq_to_windows(words, tags, word_to_num, tag_to_num, pad, pad)
 
 def window_to_vec(window, L):
     """Concatenate word vectors for a given window."""
-    return concatenate([L[i] for i in window])
+    return L[asarray(window)].reshape(-1)
+
+def ids_to_windows(ids, offsets, word_to_num, wsize=3):
+    """
+    Windows of every token of sentences given as one id array with sentence
+    offsets (see conll_to_ids), each sentence padded with <s> and </s> as
+    in docs_to_windows.
+    """
+    pad = (wsize - 1)/2
+    nsent = len(offsets) - 1
+    padded = empty(len(ids) + 2*pad*nsent, dtype=int32)
+    # Token j of sentence s moves right by the pads of sentences 0..s
+    sent = repeat(arange(nsent), diff(offsets))
+    centers = arange(len(ids)) + pad*(2*sent + 1)
+    padded[centers] = ids
+    starts = offsets[:-1] + 2*pad*arange(nsent)
+    for k in range(pad):
+        padded[starts + k] = word_to_num["<s>"]
+        padded[starts + diff(offsets) + pad + k] = word_to_num["</s>"]
+    return window_ids(padded, centers, pad, pad)
+
+def load_windows(fname, word_to_num, tag_to_num, wsize=3, cache_dir=None):
+    """
+    Windows and tags of a CoNLL file, equal to
+    docs_to_windows(load_dataset(fname), word_to_num, tag_to_num, wsize).
+
+    They are saved as .npy files in cache_dir (by default "cache" next to
+    fname) and memory-mapped on later calls, until the file, the
+    vocabulary, the tag set or wsize change.
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(fname), "cache")
+    key = cache_key(file_signature(fname), wsize,
+                    sorted(word_to_num.iteritems()),
+                    sorted(tag_to_num.iteritems()))
+    prefix = os.path.join(cache_dir, "%s.w%d" % (os.path.basename(fname), wsize))
+    files = [prefix + ".X.npy", prefix + ".y.npy"]
+    sigfile = prefix + ".signature"
+
+    if cache_valid(sigfile, key, files):
+        return tuple(load(f, mmap_mode="r") for f in files)
+
+    ids, tag_ids, offsets = conll_to_ids(fname, word_to_num, tag_to_num)
+    X = ids_to_windows(ids, offsets, word_to_num, wsize)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    save(files[0], X)
+    save(files[1], tag_ids)
+    write_signature(sigfile, key)
+    return X, tag_ids
 
 ##
 # For fixed-window LM:
 # each row of X is a list of word indices
 # each entry of y is the word index to predict
 def seq_to_lm_windows(words, word_to_num, ngram=2):
-    ns = len(words)
-    X = []
-    y = []
-    for i in range(ns):
-        if words[i] == "<s>":
-            continue # skip sentence begin, but do predict end
-        idxs = [word_to_num[words[ii]]
-                for ii in range(i - ngram + 1, i + 1)]
-        X.append(idxs[:-1])
-        y.append(idxs[-1])
-    return array(X), array(y)
+    words = array(words)
+    centers = flatnonzero(words != "<s>") # skip sentence begin, but do predict end
+    ids = unique_map(words, word_to_num.__getitem__).astype(int32)
+    windows = window_ids(ids, centers, left=ngram - 1, right=0)
+    return windows[:, :-1], windows[:, -1]
 
 def docs_to_lm_windows(docs, word_to_num, ngram=2):
     docs = flatten1([pad_sequence(seq, left=(ngram-1), right=1)
                      for seq in docs])
-    words = [canonicalize_word(wt[0], word_to_num) for wt in docs]
+    words = canonicalize_words([wt[0] for wt in docs], word_to_num)
     return seq_to_lm_windows(words, word_to_num, ngram)
 
 
@@ -189,4 +292,4 @@ def idxs_to_matrix(idxs, L):
     """Return a matrix X with each row
     as a word vector for the corresponding
     index in idxs."""
-    return vstack([L[i] for i in idxs])
\ No newline at end of file
+    return L[asarray(idxs)]
\ No newline at end of file
@@ -1,3 +1,5 @@
+import tensorflow as tf
+
 class Model(object):
   """Abstracts a Tensorflow graph for a learning task.
 
@@ -121,3 +123,53 @@ class LanguageModel(Model):
     """Add embedding layer. that maps from vocabulary to vectors.
     """
     raise NotImplementedError("Each Model must re-implement this method.")
+
+class InGraphDataset(object):
+  """Holds a dataset inside the graph so that training steps need no feed.
+
+  The arrays are fed once into a tf.data pipeline that (optionally)
+  shuffles them, splits them into batches and repeats forever. next_batch
+  holds the tensors of the next batch; a model can use them as the default
+  values of its input placeholders (tf.placeholder_with_default), so steps
+  that feed the placeholders, such as predictions, are unaffected.
+  """
+
+  def __init__(self, dtypes, shapes, batch_size=None, shuffle=False):
+    """
+    Args:
+      dtypes: dtype of each array
+      shapes: shape of one example of each array
+      batch_size: examples per batch, or None if every example already is a
+                  whole batch
+      shuffle: reshuffle the examples on every pass
+    """
+    self.batch_size = batch_size
+    self.placeholders = tuple(tf.placeholder(dtype, shape=(None,) + shape)
+                              for dtype, shape in zip(dtypes, shapes))
+    dataset = tf.data.Dataset.from_tensor_slices(self.placeholders)
+    if shuffle:
+      num_examples = tf.cast(tf.shape(self.placeholders[0])[0], tf.int64)
+      dataset = dataset.shuffle(num_examples)
+    if batch_size:
+      dataset = dataset.batch(batch_size)
+    # Repeat after batching, so every pass has the same batches as one
+    # epoch of data_iterator
+    self.iterator = dataset.repeat().make_initializable_iterator()
+    self.next_batch = self.iterator.get_next()
+    self.source = None
+
+  def load(self, session, *arrays):
+    """Load arrays into the graph, unless they are already loaded there."""
+    source = (session,) + arrays
+    if (self.source is None or len(self.source) != len(source) or
+        any(a is not b for a, b in zip(self.source, source))):
+      session.run(self.iterator.initializer,
+                  feed_dict=dict(zip(self.placeholders, arrays)))
+      self.source = source
+
+  def batch_sizes(self, num_examples):
+    """Sizes of the batches of one pass over num_examples examples."""
+    if not self.batch_size:
+      return [None] * num_examples
+    return [min(self.batch_size, num_examples - start)
+            for start in xrange(0, num_examples, self.batch_size)]
@@ -0,0 +1,61 @@
+"""NumPy-only inference for the window NER model of q2_NER.py.
+
+NERModel.export (or q2_NER.export_NER) writes the trained parameters, the
+vocabulary and the tag set to a single .npz file. NERInference loads that
+file and tags windows without TensorFlow, a checkpoint or any training data.
+
+The hidden layer tanh(concat(L[w_1], ..., L[w_n]) W + b1) equals
+tanh(sum_k L[w_k] W_k + b1), where W_k are the rows of W that multiply the
+k-th word of the window. With projections, the tables L W_k are computed
+once, and the first layer of each window is n row lookups and adds instead
+of a matrix product. The tables take window_size * vocabulary * hidden
+floats, window_size * hidden_size / embed_size times the size of L.
+"""
+import numpy as np
+
+class NERInference(object):
+  """The forward pass of NERModel at inference time (no dropout)."""
+
+  def __init__(self, L, W, b1, U, b2, words, tagnames, projections=False):
+    self.L, self.W, self.b1, self.U, self.b2 = L, W, b1, U, b2
+    self.window_size = W.shape[0] // L.shape[1]
+    self.word_to_num = dict(zip(words, xrange(len(words))))
+    self.num_to_tag = dict(enumerate(tagnames))
+    self.tables = self.projection_tables() if projections else None
+
+  @classmethod
+  def load(cls, filename, projections=False):
+    data = np.load(filename)
+    return cls(data['L'], data['W'], data['b1'], data['U'], data['b2'],
+               data['words'].tolist(), data['tagnames'].tolist(),
+               projections)
+
+  def projection_tables(self):
+    """(window_size, vocabulary, hidden) array of the tables L W_k."""
+    W = self.W.reshape(self.window_size, self.L.shape[1], -1)
+    return np.array([np.dot(self.L, W_k) for W_k in W])
+
+  def logits(self, x):
+    """Unnormalized tag scores of a batch of windows of word ids."""
+    if self.tables is not None:
+      hidden = np.take(self.tables[0], x[:, 0], axis=0)
+      for k in xrange(1, self.window_size):
+        hidden += np.take(self.tables[k], x[:, k], axis=0)
+      hidden += self.b1
+    else:
+      window = np.take(self.L, x, axis=0).reshape(len(x), -1)
+      hidden = np.dot(window, self.W)
+      hidden += self.b1
+    np.tanh(hidden, out=hidden)
+    scores = np.dot(hidden, self.U)
+    scores += self.b2
+    return scores
+
+  def predict(self, X, batch_size=4096):
+    """Predicted tag indices of the windows in X, batch_size at a time."""
+    X = np.asarray(X)
+    results = np.empty(len(X), dtype=np.int32)
+    for start in xrange(0, len(X), batch_size):
+      x = X[start:start + batch_size]
+      results[start:start + len(x)] = self.logits(x).argmax(axis=1)
+    return results
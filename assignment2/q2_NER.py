@@ -1,5 +1,7 @@
 import os
 import getpass
+import glob
+import multiprocessing as mp
 import sys
 import time
 
@@ -8,8 +10,9 @@ import tensorflow as tf
 from q2_initialization import xavier_weight_init
 import data_utils.utils as du
 import data_utils.ner as ner
+import data_utils.ner_eval as ner_eval
 from utils import data_iterator
-from model import LanguageModel
+from model import InGraphDataset, LanguageModel
 
 class Config(object):
   """Holds model hyperparams and data information.
@@ -28,6 +31,10 @@ class Config(object):
   lr = 0.000479
   l2 = 0.007018
   window_size = 3
+  # Minibatches prepared ahead on a background thread
+  prefetch = 2
+  # Keep the training set in the graph instead of feeding every batch
+  in_graph_data = False
 
 class NERModel(LanguageModel):
   """Implements a NER (Named Entity Recognition) model.
@@ -37,35 +44,42 @@ class NERModel(LanguageModel):
   the standard Model method.
   """
 
+  vocab_file = 'data/ner/vocab.txt'
+  wv_file = 'data/ner/wordVectors.txt'
+  tagnames = ['O', 'LOC', 'MISC', 'ORG', 'PER']
+  # CoNLL file of each split; the test set has dummy labels only
+  split_files = {'train': 'data/ner/train', 'dev': 'data/ner/dev',
+                 'test': 'data/ner/test.masked'}
+
   def load_data(self, debug=False):
-    """Loads starter word-vectors and train/dev/test data."""
+    """Loads starter word-vectors and the tag set.
+
+    The train/dev/test windows are loaded by load_split when first used.
+    """
     # Load the starter word vectors
-    self.wv, word_to_num, num_to_word = ner.load_wv(
-      'data/ner/vocab.txt', 'data/ner/wordVectors.txt')
-    tagnames = ['O', 'LOC', 'MISC', 'ORG', 'PER']
-    self.num_to_tag = dict(enumerate(tagnames))
-    tag_to_num = {v:k for k,v in self.num_to_tag.iteritems()}
-
-    # Load the training set
-    docs = du.load_dataset('data/ner/train')
-    self.X_train, self.y_train = du.docs_to_windows(
-        docs, word_to_num, tag_to_num, wsize=self.config.window_size)
-    if debug:
-      self.X_train = self.X_train[:1024]
-      self.y_train = self.y_train[:1024]
-
-    # Load the dev set (for tuning hyperparameters)
-    docs = du.load_dataset('data/ner/dev')
-    self.X_dev, self.y_dev = du.docs_to_windows(
-        docs, word_to_num, tag_to_num, wsize=self.config.window_size)
-    if debug:
-      self.X_dev = self.X_dev[:1024]
-      self.y_dev = self.y_dev[:1024]
-
-    # Load the test set (dummy labels only)
-    docs = du.load_dataset('data/ner/test.masked')
-    self.X_test, self.y_test = du.docs_to_windows(
-        docs, word_to_num, tag_to_num, wsize=self.config.window_size)
+    self.wv, self.word_to_num, num_to_word = ner.load_wv(
+      self.vocab_file, self.wv_file)
+    self.num_to_tag = dict(enumerate(self.tagnames))
+    self.tag_to_num = {v:k for k,v in self.num_to_tag.iteritems()}
+    self.debug = debug
+    self.splits = {}
+
+  def load_split(self, name):
+    """Windows and tags of a split, read from the preprocessed cache."""
+    if name not in self.splits:
+      X, y = du.load_windows(self.split_files[name], self.word_to_num,
+                             self.tag_to_num, wsize=self.config.window_size)
+      if self.debug and name != 'test':
+        X, y = X[:1024], y[:1024]
+      self.splits[name] = X, y
+    return self.splits[name]
+
+  X_train = property(lambda self: self.load_split('train')[0])
+  y_train = property(lambda self: self.load_split('train')[1])
+  X_dev = property(lambda self: self.load_split('dev')[0])
+  y_dev = property(lambda self: self.load_split('dev')[1])
+  X_test = property(lambda self: self.load_split('test')[0])
+  y_test = property(lambda self: self.load_split('test')[1])
 
   def add_placeholders(self):
     """Generate placeholder variables to represent the input tensors
@@ -79,9 +93,12 @@ class NERModel(LanguageModel):
     input_placeholder: Input placeholder tensor of shape
                        (None, window_size), type tf.int32
     labels_placeholder: Labels placeholder tensor of shape
-                        (None, label_size), type tf.float32
+                        (None,), type tf.int32, holding tag indices
     dropout_placeholder: Dropout value placeholder (scalar),
                          type tf.float32
+    lr_placeholder, l2_placeholder: Learning rate and l2 strength (scalars),
+                                    defaulting to config.lr and config.l2,
+                                    so one graph can train any configuration
 
     Add these placeholders to self as the instance variables
   
@@ -93,9 +110,22 @@ class NERModel(LanguageModel):
     """
     ### YOUR CODE HERE
 
-    self.input_placeholder = tf.placeholder(dtype=tf.int32, shape = (None,self.config.window_size))
-    self.labels_placeholder = tf.placeholder(dtype=tf.float32, shape = (None, self.config.label_size))
+    if self.config.in_graph_data:
+      # Training batches come from the graph unless inputs are fed
+      self.train_data = InGraphDataset(
+          (tf.int32, tf.int32), ((self.config.window_size,), ()),
+          batch_size=self.config.batch_size, shuffle=True)
+      x, y = self.train_data.next_batch
+      self.input_placeholder = tf.placeholder_with_default(x, shape = (None,self.config.window_size))
+      self.labels_placeholder = tf.placeholder_with_default(y, shape = (None,))
+    else:
+      self.input_placeholder = tf.placeholder(dtype=tf.int32, shape = (None,self.config.window_size))
+      self.labels_placeholder = tf.placeholder(dtype=tf.int32, shape = (None,))
     self.dropout_placeholder = tf.placeholder(dtype=tf.float32)
+    self.lr_placeholder = tf.placeholder_with_default(
+        np.float32(self.config.lr), shape=())
+    self.l2_placeholder = tf.placeholder_with_default(
+        np.float32(self.config.l2), shape=())
 
 
     ### END YOUR CODE
@@ -125,8 +155,10 @@ class NERModel(LanguageModel):
     feed_dict = {}
     feed_dict[self.input_placeholder] = input_batch
     feed_dict[self.dropout_placeholder] = dropout
+    feed_dict[self.lr_placeholder] = self.config.lr
+    feed_dict[self.l2_placeholder] = self.config.l2
 
-    if np.any(label_batch):
+    if label_batch is not None:
       feed_dict[self.labels_placeholder] = label_batch
 
     ### END YOUR CODE
@@ -163,6 +195,7 @@ class NERModel(LanguageModel):
       window = tf.nn.embedding_lookup(L, self.input_placeholder) # this will be of the shape (len(input_placeholder), window_size,embed_size)
       window = tf.reshape(window, shape = (-1, self.config.window_size*self.config.embed_size))
       ### END YOUR CODE
+      self.L = L
       return window
 
   def add_model(self, window):
@@ -199,30 +232,32 @@ class NERModel(LanguageModel):
     label_size = self.config.label_size
 
     with tf.variable_scope('layer'):
-      W = tf.get_variable('weights', shape = (window_size*embed_size,hidden_size), initializer=xavier_weight_init(), regularizer =tf.contrib.layers.l2_regularizer(scale = self.config.l2) )
+      W = tf.get_variable('weights', shape = (window_size*embed_size,hidden_size), initializer=xavier_weight_init(), regularizer =tf.contrib.layers.l2_regularizer(scale = self.l2_placeholder) )
       b1 = tf.get_variable('bias', shape = (1, hidden_size), initializer= tf.constant_initializer(0.0))
       layer1 = tf.tanh(tf.matmul(window,W) + b1)
       layer1_dropout = tf.nn.dropout(layer1, self.dropout_placeholder)
     with tf.variable_scope('softmax'):
-      U = tf.get_variable('weights', shape =(hidden_size,label_size), initializer= xavier_weight_init(), regularizer =tf.contrib.layers.l2_regularizer(scale = self.config.l2))
+      U = tf.get_variable('weights', shape =(hidden_size,label_size), initializer= xavier_weight_init(), regularizer =tf.contrib.layers.l2_regularizer(scale = self.l2_placeholder))
       b2 = tf.get_variable('bias', shape = (1, label_size), initializer=tf.constant_initializer(0.0))
       layer2 = tf.matmul(layer1_dropout, U) +  b2 # we are not applying softmax here, instead will call tf.nn.softmax_cross_entropy_with_logits below
       output = tf.nn.dropout(layer2, self.dropout_placeholder)
     ### END YOUR CODE
+    self.W, self.b1, self.U, self.b2 = W, b1, U, b2
     return output 
 
   def add_loss_op(self, y):
     """Adds cross_entropy_loss ops to the computational graph.
 
-    Hint: You can use tf.nn.softmax_cross_entropy_with_logits to simplify your
-          implementation. You might find tf.reduce_mean useful.
+    Hint: You can use tf.nn.sparse_softmax_cross_entropy_with_logits to
+          simplify your implementation, since the labels are tag indices.
+          You might find tf.reduce_mean useful.
     Args:
       pred: A tensor of shape (batch_size, n_classes)
     Returns:
       loss: A 0-d tensor (scalar)
     """
     ### YOUR CODE HERE
-    loss = tf.nn.softmax_cross_entropy_with_logits(labels = self.labels_placeholder, logits = y)
+    loss = tf.nn.sparse_softmax_cross_entropy_with_logits(labels = self.labels_placeholder, logits = y)
     loss = tf.reduce_mean(loss)
     loss += sum(tf.get_collection(tf.GraphKeys.REGULARIZATION_LOSSES))
 
@@ -251,7 +286,7 @@ class NERModel(LanguageModel):
       train_op: The Op for training.
     """
     ### YOUR CODE HERE
-    opt = tf.train.AdamOptimizer()
+    opt = tf.train.AdamOptimizer(self.lr_placeholder)
     train_op = opt.minimize(loss)
     ### END YOUR CODE
     return train_op
@@ -266,9 +301,8 @@ class NERModel(LanguageModel):
 
     self.loss = self.add_loss_op(y)
     self.predictions = tf.nn.softmax(y)
-    one_hot_prediction = tf.argmax(self.predictions, 1)
-    correct_prediction = tf.equal(
-        tf.argmax(self.labels_placeholder, 1), one_hot_prediction)
+    one_hot_prediction = tf.cast(tf.argmax(self.predictions, 1), tf.int32)
+    correct_prediction = tf.equal(self.labels_placeholder, one_hot_prediction)
     self.correct_predictions = tf.reduce_sum(tf.cast(correct_prediction, 'int32'))
     self.train_op = self.add_training_op(self.loss)
 
@@ -281,14 +315,26 @@ class NERModel(LanguageModel):
     total_correct_examples = 0
     total_processed_examples = 0
     total_steps = len(orig_X) / self.config.batch_size
-    for step, (x, y) in enumerate(
-      data_iterator(orig_X, orig_y, batch_size=self.config.batch_size,
-                   label_size=self.config.label_size, shuffle=shuffle)):
-      feed = self.create_feed_dict(input_batch=x, dropout=dp, label_batch=y)
+    if self.config.in_graph_data:
+      # Only scalars are fed; the batches are drawn inside the graph, which
+      # always shuffles
+      self.train_data.load(session, orig_X, orig_y)
+      steps = [(batch_size, {self.dropout_placeholder: dp,
+                             self.lr_placeholder: self.config.lr,
+                             self.l2_placeholder: self.config.l2})
+               for batch_size in self.train_data.batch_sizes(len(orig_X))]
+    else:
+      steps = ((len(x), self.create_feed_dict(input_batch=x, dropout=dp,
+                                              label_batch=y))
+               for x, y in data_iterator(
+                   orig_X, orig_y, batch_size=self.config.batch_size,
+                   label_size=self.config.label_size, shuffle=shuffle,
+                   one_hot=False, prefetch=self.config.prefetch))
+    for step, (batch_size, feed) in enumerate(steps):
       loss, total_correct, _ , merged= session.run(
           [self.loss, self.correct_predictions, self.train_op,  self.merged ],
           feed_dict=feed)
-      total_processed_examples += len(x)
+      total_processed_examples += batch_size
       total_correct_examples += total_correct
       total_loss.append(loss)
 
@@ -301,22 +347,31 @@ class NERModel(LanguageModel):
         sys.stdout.flush()
     return np.mean(total_loss), total_correct_examples / float(total_processed_examples), merged
 
-  def predict(self, session, X, y=None):
-    """Make predictions from the provided model."""
+  def sentence_starts(self, x):
+    """Mask of the windows whose center word begins a sentence."""
+    pad = (self.config.window_size - 1) // 2
+    if pad == 0:
+      return None
+    return x[:, pad - 1] == self.word_to_num['<s>']
+
+  def predict(self, session, X, y=None, evaluator=None):
+    """Make predictions from the provided model.
+
+    If evaluator (a ner_eval.NEREvaluator) is given along with y, the
+    predictions are scored batch by batch as they are made.
+    """
     # If y is given, the loss is also calculated
     # We deactivate dropout by setting it to 1
     dp = 1
     losses = []
-    results = []
-    if np.any(y):
-        data = data_iterator(X, y, batch_size=self.config.batch_size,
-                             label_size=self.config.label_size, shuffle=False)
-    else:
-        data = data_iterator(X, batch_size=self.config.batch_size,
-                             label_size=self.config.label_size, shuffle=False)
+    results = np.empty(len(X), dtype=np.int32)
+    done = 0
+    data = data_iterator(X, y, batch_size=self.config.batch_size,
+                         label_size=self.config.label_size, shuffle=False,
+                         one_hot=False, prefetch=self.config.prefetch)
     for step, (x, y) in enumerate(data):
       feed = self.create_feed_dict(input_batch=x, dropout=dp)
-      if np.any(y):
+      if y is not None:
         feed[self.labels_placeholder] = y
         loss, preds = session.run(
             [self.loss, self.predictions], feed_dict=feed)
@@ -324,30 +379,46 @@ class NERModel(LanguageModel):
       else:
         preds = session.run(self.predictions, feed_dict=feed)
       predicted_indices = preds.argmax(axis=1)
-      results.extend(predicted_indices)
-    return np.mean(losses), results
+      results[done:done + len(x)] = predicted_indices
+      done += len(x)
+      if evaluator is not None and y is not None:
+        evaluator.update(y, predicted_indices, self.sentence_starts(x))
+    if evaluator is not None:
+      evaluator.finish()
+    return np.mean(losses) if losses else float('nan'), results
+
+  def export(self, session, filename):
+    """Save the trained parameters with the vocabulary and tag set to one
+    .npz file, which ner_numpy.NERInference runs without TensorFlow."""
+    L, W, b1, U, b2 = session.run([self.L, self.W, self.b1, self.U, self.b2])
+    words = sorted(self.word_to_num, key=self.word_to_num.get)
+    np.savez(filename, L=L, W=W, b1=b1, U=U, b2=b2, words=np.array(words),
+             tagnames=np.array(self.tagnames))
 
 def print_confusion(confusion, num_to_tag):
     """Helper method that prints confusion matrix."""
-    # Summing top to bottom gets the total number of tags guessed as T
-    total_guessed_tags = confusion.sum(axis=0)
-    # Summing left to right gets the total number of true tags
-    total_true_tags = confusion.sum(axis=1)
     print
     print confusion
+    prec, recall, f1 = ner_eval.precision_recall_f1(confusion)
+    for i, tag in sorted(num_to_tag.items()):
+        print 'Tag: {} - P {:2.4f} / R {:2.4f} / F1 {:2.4f}'.format(
+            tag, prec[i], recall[i], f1[i])
+
+def print_evaluation(evaluator, num_to_tag):
+    """Helper method that prints token and entity scores of an evaluator."""
+    print_confusion(evaluator.confusion, num_to_tag)
+    prec, recall, f1 = evaluator.entity_scores()
     for i, tag in sorted(num_to_tag.items()):
-        prec = confusion[i, i] / float(total_guessed_tags[i])
-        recall = confusion[i, i] / float(total_true_tags[i])
-        print 'Tag: {} - P {:2.4f} / R {:2.4f}'.format(tag, prec, recall)
+        if i != evaluator.outside:
+            print 'Entity: {} - P {:2.4f} / R {:2.4f} / F1 {:2.4f}'.format(
+                tag, prec[i], recall[i], f1[i])
+    print 'Entity F1: P {:2.4f} / R {:2.4f} / F1 {:2.4f}'.format(
+        *evaluator.entity_f1())
 
 def calculate_confusion(config, predicted_indices, y_indices):
     """Helper method that calculates confusion matrix."""
-    confusion = np.zeros((config.label_size, config.label_size), dtype=np.int32)
-    for i in xrange(len(y_indices)):
-        correct_label = y_indices[i]
-        guessed_label = predicted_indices[i]
-        confusion[correct_label, guessed_label] += 1
-    return confusion
+    return ner_eval.confusion_matrix(y_indices, predicted_indices,
+                                     config.label_size)
 
 def save_predictions(predictions, filename):
   """Saves predictions to provided file."""
@@ -355,13 +426,118 @@ def save_predictions(predictions, filename):
     for prediction in predictions:
       f.write(str(prediction) + "\n")
 
-def hyperparameter_search_NER():
-  """Test NER model implementation.
-
-  You can use this function to test your implementation of the Named Entity
-  Recognition network. When debugging, set max_epochs in the Config object to 1
-  so you can rapidly iterate.
+def export_NER(weights='./weights/ner.weights_02',
+               filename='./weights/ner.model_02.npz'):
+  """Export a checkpoint saved by test_NER for ner_numpy."""
+  with tf.Graph().as_default():
+    model = NERModel(Config())
+    saver = tf.train.Saver()
+    with tf.Session() as session:
+      saver.restore(session, weights)
+      model.export(session, filename)
+
+def weights_file(learn, reg):
+  return './weights/ner.weights_l{}_r{}'.format(learn, reg)
+
+def last_weights_file(learn, reg):
+  """Checkpoint a search round leaves for the next one to resume from."""
+  return './weights/ner.last_l{}_r{}'.format(learn, reg)
+
+def remove_checkpoint(prefix):
+  """Delete the files of the checkpoint saved under prefix."""
+  for fname in glob.glob(prefix + '.*'):
+    os.remove(fname)
+
+# Graph, model, initializer, saver and session of this search worker,
+# built by the first configuration it trains and reused by the others
+search_graph = None
+
+def get_search_graph():
+  global search_graph
+  if search_graph is None:
+    graph = tf.Graph()
+    with graph.as_default():
+      model = NERModel(Config())
+      model.merged = tf.summary.merge_all()
+      init = tf.initialize_all_variables()
+      # Keep every configuration's checkpoints, not just the last 5 saved
+      saver = tf.train.Saver(max_to_keep=None)
+    # Share the CPUs between the worker processes
+    threads = max(1, mp.cpu_count() // search_jobs)
+    session_config = tf.ConfigProto(intra_op_parallelism_threads=threads,
+                                    inter_op_parallelism_threads=threads)
+    session = tf.Session(graph=graph, config=session_config)
+    search_graph = model, init, saver, session
+  return search_graph
+
+def train_NER_config(task):
+  """Trains one configuration of the hyperparameter search for some epochs.
+
+  task is (learn, reg, start, stop, best_val_loss, best_val_epoch): epochs
+  start..stop-1 are trained, resuming from the checkpoint of the previous
+  round when start > 0. The worker's graph is reused; only the fed
+  learning rate and l2 strength change between configurations.
+
+  Returns (learn, reg, validation losses, best_val_loss, best_val_epoch,
+  whether training stopped early).
   """
+  learn, reg, start, stop, best_val_loss, best_val_epoch = task
+  model, init, saver, session = get_search_graph()
+  config = model.config
+  config.l2 = reg
+  config.lr = learn
+  last_file = last_weights_file(learn, reg)
+  val_losses = []
+  stopped = False
+
+  if start > 0:
+    saver.restore(session, last_file)
+  else:
+    session.run(init)
+
+  for epoch in xrange(start, stop):
+    model.run_epoch(session, model.X_train, model.y_train, verbose=False)
+    val_loss, _ = model.predict(session, model.X_dev, model.y_dev)
+    val_losses.append(val_loss)
+    if val_loss < best_val_loss:
+      best_val_loss = val_loss
+      best_val_epoch = epoch
+      # Workers save concurrently; checkpoints are always restored by
+      # path, so none of them updates the shared ./weights/checkpoint file
+      saver.save(session, weights_file(learn, reg), write_state=False)
+    if epoch - best_val_epoch > config.early_stopping:
+      stopped = True
+      break
+  saver.save(session, last_file, write_state=False)
+
+  print 'l_{}_r{}: epochs {}-{}, best valid loss {} at epoch {}'.format(
+      learn, reg, start, start + len(val_losses) - 1, best_val_loss,
+      best_val_epoch)
+  sys.stdout.flush()
+  return learn, reg, val_losses, best_val_loss, best_val_epoch, stopped
+
+# Number of worker processes of the running search
+search_jobs = 1
+
+def init_search_worker(jobs):
+  global search_jobs
+  search_jobs = jobs
+
+def hyperparameter_search_NER(jobs=None, eta=3):
+  """Search the learning rate and l2 strength of the NER model.
+
+  25 random (lr, l2) configurations are trained in parallel by jobs worker
+  processes, with successive halving: every configuration is trained for a
+  few epochs, then only the best 1/eta by validation loss continue for eta
+  times as many, and so on until config.max_epochs. Test predictions are
+  written for the configuration with the best validation loss, whose
+  checkpoint is the only one kept.
+
+  The windows of every split are built once up front and cached on disk,
+  so the workers only memory-map them.
+  """
+  jobs = jobs or mp.cpu_count()
+  config = Config()
 
   learn_list = 10**np.random.uniform(-4,-2, 5)
   reg_list = 10**np.random.uniform(-4, -2, 5)
@@ -373,68 +549,77 @@ def hyperparameter_search_NER():
     for reg in reg_list:
       valid_dict['l_{}_r{}'.format(learn, reg)]=[]
 
-  for learn in learn_list:
-    for reg in reg_list:
-      config = Config()
-      config.l2 = reg
-      config.lr = learn
-      with tf.Graph().as_default():
-        model = NERModel(config)
-
-        init = tf.initialize_all_variables()
-        saver = tf.train.Saver()
-
-        with tf.Session() as session:
-          best_val_loss = float('inf')
-          best_val_epoch = 0
-
-          session.run(init)
-          model.merged = tf.summary.merge_all()
-          train_writer = tf.summary.FileWriter( './train',tf.get_default_graph())
-          test_writer = tf.summary.FileWriter( './test')
-
-          for epoch in xrange(config.max_epochs):
-            print 'Epoch {}'.format(epoch)
-            start = time.time()
-            ###
-            train_loss, train_acc, summary = model.run_epoch(session, model.X_train,
-                                                    model.y_train)
-
-            train_writer.add_summary(summary, epoch)
-            val_loss, predictions = model.predict(session, model.X_dev, model.y_dev)
-
-            print 'Training loss: {}'.format(train_loss)
-            print 'Training acc: {}'.format(train_acc)
-            print 'Validation loss: {}'.format(val_loss)
-
-            valid_dict['l_{}_r{}'.format(learn, reg)].append(val_loss)
-            if val_loss < best_val_loss:
-              best_val_loss = val_loss
-              best_val_epoch = epoch
-              if not os.path.exists("./weights"):
-                os.makedirs("./weights")
-
-              saver.save(session, './weights/ner.weights_l{}_r{}'.format(learn, reg))
-
-            if epoch - best_val_epoch > config.early_stopping:
-              break
-            ###
-            confusion = calculate_confusion(config, predictions, model.y_dev)
-            print_confusion(confusion, model.num_to_tag)
-            print 'Total time: {}'.format(time.time() - start)
-
-
-          train_writer.close()
-          saver.restore(session, './weights/ner.weights_l{}_r{}'.format(learn, reg))
-          print 'Test'
-          print '=-=-='
-          print "Best valid loss :", best_val_loss
-          print "Best valid epoch:", best_val_epoch
-          print "Learn:", learn
-          print "Reg:", reg
-          print 'Writing predictions to q2_test.predicted'
-          _, predictions = model.predict(session, model.X_test, model.y_test)
-          save_predictions(predictions, "q2_test.predicted_l{}_r{}".format(learn, reg))
+  # Preprocess every split once, before the workers start
+  wv, word_to_num, _ = ner.load_wv(NERModel.vocab_file, NERModel.wv_file)
+  tag_to_num = {tag: i for i, tag in enumerate(NERModel.tagnames)}
+  for fname in NERModel.split_files.itervalues():
+    du.load_windows(fname, word_to_num, tag_to_num, wsize=config.window_size)
+  if not os.path.exists("./weights"):
+    os.makedirs("./weights")
+
+  # Epoch budgets of the rounds, growing by eta up to max_epochs
+  num_rounds = int(np.floor(np.log(len(valid_dict)) / np.log(eta))) + 1
+  budgets = [max(1, int(round(config.max_epochs * eta**(i - num_rounds + 1))))
+             for i in xrange(num_rounds)]
+  # Small max_epochs round several budgets to the same epoch; such a round
+  # would train nothing and only cut configurations
+  budgets = sorted(set(budgets))
+
+  # (learn, reg) -> (best_val_loss, best_val_epoch)
+  results = {(learn, reg): (float('inf'), 0)
+             for learn in learn_list for reg in reg_list}
+  alive = sorted(results)
+  trained = 0
+  pool = mp.Pool(jobs, initializer=init_search_worker, initargs=(jobs,))
+  try:
+    for i, budget in enumerate(budgets):
+      print 'Round {}: {} configurations up to epoch {}'.format(
+          i, len(alive), budget)
+      tasks = [(learn, reg, trained, budget) + results[learn, reg]
+               for learn, reg in alive]
+      stopped = set()
+      for learn, reg, val_losses, best_val_loss, best_val_epoch, early in (
+          pool.imap_unordered(train_NER_config, tasks)):
+        valid_dict['l_{}_r{}'.format(learn, reg)].extend(val_losses)
+        results[learn, reg] = best_val_loss, best_val_epoch
+        if early:
+          stopped.add((learn, reg))
+      trained = budget
+      # Keep the best 1/eta of the configurations that trained the whole
+      # budget; those that stopped early are done and take no slot
+      finished = [c for c in alive if c not in stopped]
+      ranked = sorted(finished, key=lambda c: results[c][0])
+      alive = ranked[:max(1, len(alive) // eta)]
+      if not alive:
+        break
+  finally:
+    pool.close()
+    pool.join()
+
+  print 'Test'
+  print '=-=-='
+  ranked = sorted(results.iteritems(), key=lambda item: item[1][0])
+  for (learn, reg), (best_val_loss, best_val_epoch) in ranked:
+    print 'Learn: {} Reg: {} Best valid loss: {} Best valid epoch: {}'.format(
+        learn, reg, best_val_loss, best_val_epoch)
+
+  (learn, reg), _ = ranked[0]
+  config.l2 = reg
+  config.lr = learn
+  with tf.Graph().as_default():
+    model = NERModel(config)
+    saver = tf.train.Saver()
+    with tf.Session() as session:
+      saver.restore(session, weights_file(learn, reg))
+      print 'Writing predictions to q2_test.predicted'
+      _, predictions = model.predict(session, model.X_test, model.y_test)
+      save_predictions(predictions, "q2_test.predicted_l{}_r{}".format(learn, reg))
+
+  # Only the best configuration's checkpoint is worth keeping
+  for config_learn, config_reg in results:
+    remove_checkpoint(last_weights_file(config_learn, config_reg))
+    if (config_learn, config_reg) != (learn, reg):
+      remove_checkpoint(weights_file(config_learn, config_reg))
 
   import pickle
   pickle.dump(valid_dict, open("./valid_dict", 'wb'))
@@ -486,7 +671,9 @@ def test_NER():
                                                 model.y_train)
 
         train_writer.add_summary(summary, epoch)
-        val_loss, predictions = model.predict(session, model.X_dev, model.y_dev)
+        evaluator = ner_eval.NEREvaluator(config.label_size)
+        val_loss, predictions = model.predict(session, model.X_dev, model.y_dev,
+                                              evaluator)
 
         print 'Training loss: {}'.format(train_loss)
         print 'Training acc: {}'.format(train_acc)
@@ -505,13 +692,13 @@ def test_NER():
         if epoch - best_val_epoch > config.early_stopping:
           break
         ###
-        confusion = calculate_confusion(config, predictions, model.y_dev)
-        print_confusion(confusion, model.num_to_tag)
+        print_evaluation(evaluator, model.num_to_tag)
         print 'Total time: {}'.format(time.time() - start)
 
 
       train_writer.close()
       saver.restore(session, './weights/ner.weights_02')
+      model.export(session, './weights/ner.model_02.npz')
       print 'Test'
       print '=-=-='
       print "Best valid loss :", best_val_loss
@@ -0,0 +1,112 @@
+"""Tag tokenized text with a trained NER model.
+
+Reads one tokenized sentence per line (tokens separated by whitespace) and
+writes CoNLL-style "token<TAB>tag" lines, with a blank line after each
+sentence. Input is read and tagged in chunks of sentences, so output is
+written as it goes and memory stays bounded however long the input is.
+
+With --model, a model exported by q2_NER.py is run by ner_numpy instead of
+restoring a TensorFlow checkpoint, so TensorFlow is not even imported.
+"""
+import argparse
+import itertools
+import sys
+import time
+
+import numpy as np
+import data_utils.utils as du
+
+def get_arguments():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('input', nargs='?', default='-',
+                      help='Tokenized text, one sentence per line; - for stdin.')
+  parser.add_argument('output', nargs='?', default='-',
+                      help='CoNLL-style output; - for stdout.')
+  parser.add_argument('--weights', default='./weights/ner.weights_02',
+                      help='Checkpoint saved by q2_NER.py.')
+  parser.add_argument('--model',
+                      help='Model exported by q2_NER.py (.npz); if given, '
+                      'it is used instead of --weights.')
+  parser.add_argument('--projections', action='store_true',
+                      help='With --model, precompute the per-position '
+                      'projections of the vocabulary (faster on CPU, '
+                      'more memory).')
+  parser.add_argument('--batch_size', type=int, default=4096,
+                      help='Windows per inference batch.')
+  parser.add_argument('--chunk_size', type=int, default=10000,
+                      help='Sentences read and tagged at a time.')
+  return parser.parse_args()
+
+def word_ids(words, word_to_num, cache):
+  """Ids of canonicalized words, canonicalizing each new word type once."""
+  for word in set(words).difference(cache):
+    cache[word] = word_to_num[du.canonicalize_word(word, word_to_num)]
+  return np.array([cache[word] for word in words], dtype=np.int32)
+
+def tag_chunk(predict, word_to_num, num_to_tag, window_size, lines, cache):
+  """Tag a chunk of sentences, returning the output text and token count.
+
+  predict maps an array of windows to their tag indices.
+  """
+  sentences = [line.split() for line in lines]
+  words = list(itertools.chain.from_iterable(sentences))
+  offsets = np.cumsum([0] + [len(sentence) for sentence in sentences])
+  ids = word_ids(words, word_to_num, cache)
+  X = du.ids_to_windows(ids, offsets, word_to_num, wsize=window_size)
+  predictions = predict(X)
+
+  out = []
+  for start, end in zip(offsets[:-1], offsets[1:]):
+    for word, tag in zip(words[start:end], predictions[start:end]):
+      out.append('{}\t{}\n'.format(word, num_to_tag[tag]))
+    out.append('\n')
+  return ''.join(out), len(words)
+
+def tag_file(infile, outfile, chunk_size, predict, word_to_num, num_to_tag,
+             window_size):
+  """Tag infile into outfile, returning the token count and time taken."""
+  start = time.time()
+  num_tokens = 0
+  cache = {}
+  while True:
+    lines = list(itertools.islice(infile, chunk_size))
+    if not lines:
+      break
+    text, count = tag_chunk(predict, word_to_num, num_to_tag, window_size,
+                            lines, cache)
+    outfile.write(text)
+    outfile.flush()
+    num_tokens += count
+  return num_tokens, time.time() - start
+
+def main(args):
+  infile = sys.stdin if args.input == '-' else open(args.input)
+  outfile = sys.stdout if args.output == '-' else open(args.output, 'w')
+
+  if args.model:
+    from ner_numpy import NERInference
+    model = NERInference.load(args.model, args.projections)
+    predict = lambda X: model.predict(X, args.batch_size)
+    num_tokens, elapsed = tag_file(
+        infile, outfile, args.chunk_size, predict, model.word_to_num,
+        model.num_to_tag, model.window_size)
+  else:
+    import tensorflow as tf
+    from q2_NER import Config, NERModel
+    config = Config()
+    config.batch_size = args.batch_size
+    with tf.Graph().as_default():
+      model = NERModel(config)
+      saver = tf.train.Saver()
+      with tf.Session() as session:
+        saver.restore(session, args.weights)
+        predict = lambda X: model.predict(session, X)[1]
+        num_tokens, elapsed = tag_file(
+            infile, outfile, args.chunk_size, predict, model.word_to_num,
+            model.num_to_tag, config.window_size)
+
+  print >> sys.stderr, 'tagged {} tokens in {:.1f} seconds ({:.0f} tokens/s)'.format(
+      num_tokens, elapsed, num_tokens / max(elapsed, 1e-9))
+
+if __name__ == '__main__':
+  main(get_arguments())
@@ -5,12 +5,12 @@ import time
 import numpy as np
 from copy import deepcopy
 from q2_initialization import xavier_weight_init
-from utils import calculate_perplexity, get_ptb_dataset, Vocab
-from utils import ptb_iterator, sample
+from utils import calculate_perplexity, get_ptb_dataset, load_ptb, Vocab
+from utils import ptb_batches, ptb_epoch_size, ptb_iterator, sample
 
 import tensorflow as tf
 from tensorflow.contrib.legacy_seq2seq import sequence_loss
-from model import LanguageModel
+from model import InGraphDataset, LanguageModel
 
 # Let's set the parameters of our model
 # http://arxiv.org/pdf/1409.2329v4.pdf shows parameters that would achieve near
@@ -32,22 +32,19 @@ class Config(object):
   early_stopping =30
   dropout = 0.5 # 0.9 let to overfitting
   lr = 0.001
+  # Batches sliced ahead on a background thread during each epoch
+  prefetch = 2
+  # Start each training epoch at a random offset into the corpus
+  random_offset = False
+  # Load each epoch's batches into the graph instead of feeding every step
+  in_graph_data = False
 
 class RNNLM_Model(LanguageModel):
 
   def load_data(self, debug=False):
     """Loads starter word-vectors and train/dev/test data."""
-    self.vocab = Vocab()
-    self.vocab.construct(get_ptb_dataset('train'))
-    self.encoded_train = np.array(
-        [self.vocab.encode(word) for word in get_ptb_dataset('train')],
-        dtype=np.int32)
-    self.encoded_valid = np.array(
-        [self.vocab.encode(word) for word in get_ptb_dataset('valid')],
-        dtype=np.int32)
-    self.encoded_test = np.array(
-        [self.vocab.encode(word) for word in get_ptb_dataset('test')],
-        dtype=np.int32)
+    self.vocab, (self.encoded_train, self.encoded_valid,
+                 self.encoded_test) = load_ptb()
     if debug:
       num_debug = 1024
       self.encoded_train = self.encoded_train[:num_debug]
@@ -80,8 +77,18 @@ class RNNLM_Model(LanguageModel):
     (Don't change the variable names)
     """
     ### YOUR CODE HERE
-    self.input_placeholder = tf.placeholder(dtype=tf.int32, shape=(None, self.config.num_steps))
-    self.labels_placeholder = tf.placeholder(dtype=tf.int32, shape=(None, self.config.num_steps))
+    if self.config.in_graph_data:
+      # Batches come from the graph unless inputs are fed; each example of
+      # the dataset is a whole (batch_size, num_steps) batch
+      self.epoch_data = InGraphDataset(
+          (tf.int32, tf.int32),
+          ((self.config.batch_size, self.config.num_steps),) * 2)
+      x, y = self.epoch_data.next_batch
+      self.input_placeholder = tf.placeholder_with_default(x, shape=(None, self.config.num_steps))
+      self.labels_placeholder = tf.placeholder_with_default(y, shape=(None, self.config.num_steps))
+    else:
+      self.input_placeholder = tf.placeholder(dtype=tf.int32, shape=(None, self.config.num_steps))
+      self.labels_placeholder = tf.placeholder(dtype=tf.int32, shape=(None, self.config.num_steps))
     self.dropout_placeholder = tf.placeholder(dtype=tf.float32)
     ### END YOUR CODE
   
@@ -295,17 +302,30 @@ class RNNLM_Model(LanguageModel):
     if not train_op:
       train_op = tf.no_op()
       dp = 1
-    total_steps = sum(1 for x in ptb_iterator(data, config.batch_size, config.num_steps))
+      offset = 0
+    else:
+      offset = np.random.randint(config.num_steps) if config.random_offset else 0
+    total_steps = ptb_epoch_size(
+        len(data), config.batch_size, config.num_steps, offset)
     total_loss = []
     state = self.initial_state.eval()
-    for step, (x, y) in enumerate(
-      ptb_iterator(data, config.batch_size, config.num_steps)):
+    if config.in_graph_data:
+      # One transfer per epoch; the steps then only feed the carried state
+      # and dropout
+      self.epoch_data.load(session, *ptb_batches(
+          data, config.batch_size, config.num_steps, offset))
+      batches = [(None, None)] * total_steps
+    else:
+      batches = ptb_iterator(data, config.batch_size, config.num_steps,
+                             offset=offset, prefetch=config.prefetch)
+    for step, (x, y) in enumerate(batches):
       # We need to pass in the initial state and retrieve the final state to give
       # the RNN proper history
-      feed = {self.input_placeholder: x,
-              self.labels_placeholder: y,
-              self.initial_state: state,
+      feed = {self.initial_state: state,
               self.dropout_placeholder: dp}
+      if x is not None:
+        feed[self.input_placeholder] = x
+        feed[self.labels_placeholder] = y
 
       #NOTICE here that the final state of this unrolling is being used as the initial state in the next step of unrolling the graph
       loss, state, _ = session.run(
@@ -361,7 +381,7 @@ def generate_text(session, model, config, starting_text='<eos>',
   """
   state = model.initial_state.eval()
   # Imagine tokens as a batch size of one, length of len(tokens[0])
-  tokens = [model.vocab.encode(word) for word in starting_text.split()]
+  tokens = model.vocab.encode_batch(starting_text.split()).tolist()
   for i in xrange(stop_length):
     ### YOUR CODE HERE
     raise NotImplementedError
@@ -370,7 +390,7 @@ def generate_text(session, model, config, starting_text='<eos>',
     tokens.append(next_word_idx)
     if stop_tokens and model.vocab.decode(tokens[-1]) in stop_tokens:
       break
-  output = [model.vocab.decode(word_idx) for word_idx in tokens]
+  output = model.vocab.decode_batch(tokens)
   return output
 
 def generate_sentence(session, model, config, *args, **kwargs):
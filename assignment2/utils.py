@@ -1,6 +1,17 @@
 from collections import defaultdict
+import itertools
+import os
+import Queue
+import sys
+import threading
 
 import numpy as np
+from data_utils.cache import cache_key, cache_valid, file_signature, write_signature
+
+PTB_FILE = 'data/ptb/ptb.{}.txt'
+PTB_SPLITS = ['train', 'valid', 'test']
+# Encoded corpus and vocabulary, rebuilt whenever a PTB file changes
+PTB_CACHE_DIR = 'data/ptb/cache'
 
 class Vocab(object):
   def __init__(self):
@@ -35,6 +46,64 @@ class Vocab(object):
   def __len__(self):
     return len(self.word_freq)
 
+  def freeze(self):
+    """Return an immutable, array-backed copy of this vocabulary."""
+    words = [self.index_to_word[i] for i in xrange(len(self.index_to_word))]
+    return FrozenVocab(words, [self.word_freq[w] for w in words], self.unknown)
+
+class FrozenVocab(object):
+  """Immutable vocabulary stored in arrays.
+
+  index_to_word and freq are arrays indexed by word id. Besides per-word
+  encode/decode, whole token sequences can be converted at once with
+  encode_batch/decode_batch, which look words up by binary search over a
+  sorted copy of the vocabulary instead of one dict access per word.
+  """
+
+  def __init__(self, words, freq, unknown='<unk>'):
+    self.index_to_word = np.array(words)
+    self.freq = np.array(freq, dtype=np.int64)
+    self.word_to_index = dict(zip(words, xrange(len(words))))
+    self.unknown = unknown
+    self.unknown_index = self.word_to_index[unknown]
+    self.total_words = float(self.freq.sum())
+    self.sorted_order = np.argsort(self.index_to_word, kind='mergesort')
+    self.sorted_words = self.index_to_word[self.sorted_order]
+
+  def encode(self, word):
+    return self.word_to_index.get(word, self.unknown_index)
+
+  def decode(self, index):
+    return self.index_to_word[index]
+
+  def encode_batch(self, words):
+    """Encode a sequence of words as an int32 array, mapping unknown words
+    to the id of <unk>."""
+    words = np.asarray(words)
+    if words.size == 0:
+      return np.zeros(words.shape, dtype=np.int32)
+    pos = np.searchsorted(self.sorted_words, words)
+    pos = np.minimum(pos, len(self.sorted_words) - 1)
+    found = self.sorted_words[pos] == words
+    return np.where(found, self.sorted_order[pos],
+                    self.unknown_index).astype(np.int32)
+
+  def decode_batch(self, indices):
+    """Decode an array of word ids into a list of words."""
+    return self.index_to_word[np.asarray(indices)].tolist()
+
+  def save(self, filename):
+    np.savez(filename, words=self.index_to_word, freq=self.freq,
+             unknown=self.unknown)
+
+  @classmethod
+  def load(cls, filename):
+    data = np.load(filename)
+    return cls(data['words'].tolist(), data['freq'], str(data['unknown']))
+
+  def __len__(self):
+    return len(self.index_to_word)
+
 def calculate_perplexity(log_probs):
   # https://web.stanford.edu/class/cs124/lec/languagemodeling.pdf
   perp = 0
@@ -43,8 +112,7 @@ def calculate_perplexity(log_probs):
   return np.exp(perp / len(log_probs))
 
 def get_ptb_dataset(dataset='train'):
-  fn = 'data/ptb/ptb.{}.txt'
-  for line in open(fn.format(dataset)):
+  for line in open(PTB_FILE.format(dataset)):
     for word in line.split():
       yield word
     # Add token to the end of the line
@@ -53,21 +121,138 @@ def get_ptb_dataset(dataset='train'):
     # https://github.com/tensorflow/tensorflow/blob/master/tensorflow/models/rnn/ptb/reader.py#L31
     yield '<eos>'
 
-def ptb_iterator(raw_data, batch_size, num_steps):
-  # Pulled from https://github.com/tensorflow/tensorflow/blob/master/tensorflow/models/rnn/ptb/reader.py#L82
-  raw_data = np.array(raw_data, dtype=np.int32)
-  data_len = len(raw_data)
-  batch_len = data_len // batch_size
-  data = np.zeros([batch_size, batch_len], dtype=np.int32)
-  for i in range(batch_size):
-    data[i] = raw_data[batch_len * i:batch_len * (i + 1)]
-  epoch_size = (batch_len - 1) // num_steps
-  if epoch_size == 0:
+def encode_ptb():
+  """Build the vocabulary and encode the training set in one pass.
+
+  Returns the frozen vocabulary and the int32 train/valid/test arrays.
+  """
+  vocab = Vocab()
+  word_to_index = vocab.word_to_index
+  train = []
+  for word in get_ptb_dataset('train'):
+    vocab.add_word(word)
+    train.append(word_to_index[word])
+  vocab.total_words = float(sum(vocab.word_freq.values()))
+  print '{} total words with {} uniques'.format(vocab.total_words, len(vocab.word_freq))
+
+  vocab = vocab.freeze()
+  encoded = [np.array(train, dtype=np.int32)]
+  for split in PTB_SPLITS[1:]:
+    encoded.append(vocab.encode_batch(list(get_ptb_dataset(split))))
+  return vocab, encoded
+
+def load_ptb(cache_dir=PTB_CACHE_DIR):
+  """Load the vocabulary and the encoded train/valid/test arrays.
+
+  The first run encodes the PTB files and saves the result to cache_dir;
+  later runs memory-map the saved arrays instead of re-reading the text.
+  """
+  key = cache_key([file_signature(PTB_FILE.format(split))
+                   for split in PTB_SPLITS])
+  signature_file = os.path.join(cache_dir, 'signature')
+  vocab_file = os.path.join(cache_dir, 'vocab.npz')
+  split_files = [os.path.join(cache_dir, '{}.npy'.format(split))
+                 for split in PTB_SPLITS]
+
+  if cache_valid(signature_file, key, [vocab_file] + split_files):
+    vocab = FrozenVocab.load(vocab_file)
+    encoded = [np.load(f, mmap_mode='r') for f in split_files]
+    return vocab, encoded
+
+  vocab, encoded = encode_ptb()
+  if not os.path.exists(cache_dir):
+    os.makedirs(cache_dir)
+  for f, data in zip(split_files, encoded):
+    np.save(f, data)
+  vocab.save(vocab_file)
+  write_signature(signature_file, key)
+  return vocab, encoded
+
+def ptb_epoch_size(data_len, batch_size, num_steps, offset=0):
+  """Number of (x, y) batches ptb_iterator yields for a corpus of data_len."""
+  batch_len = (data_len - offset) // batch_size
+  return (batch_len - 1) // num_steps
+
+def ptb_batches(raw_data, batch_size, num_steps, offset=0):
+  """All (x, y) batches of an epoch as two (epoch_size, batch_size, num_steps)
+  arrays, where x[i], y[i] is the i-th batch of ptb_iterator.
+
+  The corpus is reshaped into a (batch_size, batch_len) view rather than
+  copied, and the batches are views of that, so this costs nothing up front
+  even for a memory-mapped corpus. offset skips that many leading words.
+  """
+  raw_data = np.asarray(raw_data, dtype=np.int32)
+  batch_len = (len(raw_data) - offset) // batch_size
+  data = raw_data[offset:offset + batch_size * batch_len].reshape(
+      batch_size, batch_len)
+  epoch_size = ptb_epoch_size(len(raw_data), batch_size, num_steps, offset)
+  if epoch_size <= 0:
     raise ValueError("epoch_size == 0, decrease batch_size or num_steps")
-  for i in range(epoch_size):
-    x = data[:, i * num_steps:(i + 1) * num_steps]
-    y = data[:, i * num_steps + 1:(i + 1) * num_steps + 1]
-    yield (x, y)
+  span = epoch_size * num_steps
+  x = data[:, :span].reshape(batch_size, epoch_size, num_steps)
+  y = data[:, 1:span + 1].reshape(batch_size, epoch_size, num_steps)
+  return x.swapaxes(0, 1), y.swapaxes(0, 1)
+
+def ptb_iterator(raw_data, batch_size, num_steps, offset=0, prefetch=0):
+  # Pulled from https://github.com/tensorflow/tensorflow/blob/master/tensorflow/models/rnn/ptb/reader.py#L82
+  # Batches are views of the corpus (see ptb_batches). offset skips that
+  # many leading words, e.g. a random offset per epoch so batches do not
+  # always start at the same positions. With prefetch > 0, up to that many
+  # batches are sliced ahead on a background thread.
+  all_x, all_y = ptb_batches(raw_data, batch_size, num_steps, offset)
+  def batches():
+    for x, y in itertools.izip(all_x, all_y):
+      if prefetch:
+        # Make the copy the feed would make anyway while still on the
+        # background thread
+        x, y = np.ascontiguousarray(x), np.ascontiguousarray(y)
+      yield (x, y)
+  if prefetch:
+    return prefetch_iterator(batches(), prefetch)
+  return batches()
+
+def prefetch_iterator(iterable, size):
+  """Iterate over iterable on a background thread, keeping up to size items
+  ready in a bounded queue. Exceptions raised by the producer are re-raised
+  in the consumer."""
+  items = Queue.Queue(maxsize=size)
+  stop = threading.Event()
+  done = object()
+
+  def put(item):
+    # Give up once the consumer has stopped, instead of blocking forever
+    while not stop.is_set():
+      try:
+        items.put(item, timeout=0.1)
+        return True
+      except Queue.Full:
+        pass
+    return False
+
+  def produce():
+    try:
+      for item in iterable:
+        if not put((item, None)):
+          return
+      put((done, None))
+    except Exception:
+      put((done, sys.exc_info()))
+
+  thread = threading.Thread(target=produce)
+  thread.daemon = True
+  thread.start()
+  try:
+    while True:
+      item, error = items.get()
+      if item is done:
+        if error:
+          raise error[0], error[1], error[2]
+        return
+      yield item
+  finally:
+    # Release the producer if the consumer stops early
+    stop.set()
+    thread.join()
 
 def sample(a, temperature=1.0):
     # helper function to sample an index from a probability array
@@ -76,30 +261,63 @@ def sample(a, temperature=1.0):
     a = np.exp(a) / np.sum(np.exp(a))
     return np.argmax(np.random.multinomial(1, a, 1))
 
-def data_iterator(orig_X, orig_y=None, batch_size=32, label_size=2, shuffle=False):
-  # Optionally shuffle the data before training
-  if shuffle:
-    indices = np.random.permutation(len(orig_X))
-    data_X = orig_X[indices]
-    data_y = orig_y[indices] if np.any(orig_y) else None
-  else:
-    data_X = orig_X
-    data_y = orig_y
-  ###
-  total_processed_examples = 0
-  total_steps = int(np.ceil(len(data_X) / float(batch_size)))
-  for step in xrange(total_steps):
-    # Create the batch by selecting up to batch_size elements
-    batch_start = step * batch_size
-    x = data_X[batch_start:batch_start + batch_size]
-    # Convert our target from the class index to a one hot vector
-    y = None
-    if np.any(data_y):
-      y_indices = data_y[batch_start:batch_start + batch_size]
-      y = np.zeros((len(x), label_size), dtype=np.int32)
-      y[np.arange(len(y_indices)), y_indices] = 1
-    ###
-    yield x, y
-    total_processed_examples += len(x)
-  # Sanity check to make sure we iterated over all the dataset as intended
-  assert total_processed_examples == len(data_X), 'Expected {} and processed {}'.format(len(data_X), total_processed_examples)
+def data_iterator(orig_X, orig_y=None, batch_size=32, label_size=2,
+                  shuffle=False, one_hot=True, prefetch=0):
+  """Iterate over (x, y) minibatches of a dataset.
+
+  With shuffle, a random permutation of the row indices is drawn and each
+  batch is gathered into preallocated buffers that are reused from batch to
+  batch, so the dataset itself is never copied; otherwise batches are
+  slices of orig_X. Labels are one-hot rows, or the label indices if
+  one_hot is False. With prefetch > 0, up to that many batches are prepared
+  ahead on a background thread.
+
+  Yielded arrays may be overwritten by later batches, so copy anything that
+  has to outlive the current step.
+  """
+  orig_X = np.asarray(orig_X)
+  total_steps = int(np.ceil(len(orig_X) / float(batch_size)))
+  # Batch k is filled into buffer set k % num_buffers; one set is being
+  # consumed, up to prefetch are queued and one more is being filled
+  num_buffers = prefetch + 2 if prefetch else 1
+  x_buffers = [None] * num_buffers
+  y_buffers = [None] * num_buffers
+  indices = np.random.permutation(len(orig_X)) if shuffle else None
+
+  def batches():
+    for step in xrange(total_steps):
+      # Create the batch by selecting up to batch_size elements
+      batch_start = step * batch_size
+      batch_end = min(batch_start + batch_size, len(orig_X))
+      n = batch_end - batch_start
+      slot = step % num_buffers
+      if shuffle:
+        if x_buffers[slot] is None:
+          x_buffers[slot] = np.empty((batch_size,) + orig_X.shape[1:],
+                                     dtype=orig_X.dtype)
+        x = x_buffers[slot][:n]
+        np.take(orig_X, indices[batch_start:batch_end], axis=0, out=x,
+                mode='clip')
+      else:
+        x = orig_X[batch_start:batch_end]
+      y = None
+      if orig_y is not None:
+        if y_buffers[slot] is None:
+          y_buffers[slot] = np.empty(batch_size, dtype=np.int32)
+        y_indices = y_buffers[slot][:n]
+        if shuffle:
+          np.take(orig_y, indices[batch_start:batch_end], out=y_indices,
+                  mode='clip')
+        else:
+          y_indices[:] = orig_y[batch_start:batch_end]
+        if one_hot:
+          # Convert our target from the class index to a one hot vector
+          y = np.zeros((n, label_size), dtype=np.int32)
+          y[np.arange(n), y_indices] = 1
+        else:
+          y = y_indices
+      yield x, y
+
+  if prefetch:
+    return prefetch_iterator(batches(), prefetch)
+  return batches()